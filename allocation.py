@@ -1,5 +1,11 @@
-import random
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+from preference import facility_index_dtype
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional - without it, random serial dictatorship runs the (slower) vectorized block filling.
+    njit = None
 
 def first_choice(pref_list):
     """Returns an allocation list where each agent is assigned to their first choice.
@@ -13,32 +19,537 @@ def first_choice(pref_list):
     # shape = (nr_agents, 1)
     return pref_list[:, [0]]
 
-def random_serial_dictatorship(pref_list, capacities):
+def _serial_dictatorship(pref_list, lottery, start, remaining_capacity, assignments, full_pref_list, full_row, extend):
+    """Compiled one-by-one random serial dictatorship (used when numba is installed). Assigns the agents from position start of the lottery on, in place.
+
+    Args:
+        pref_list (np.array): the preference list, shape = (nr_agents, nr_preferences)
+        lottery (np.array): order in which the agents pick.
+        start (int): position in the lottery to continue from.
+        remaining_capacity (np.array): remaining capacity of each facility (updated in place).
+        assignments (np.array): assigned facility of each agent, -1 if not assigned yet (updated in place).
+        full_pref_list (np.array): full preference lists of the extended agents, shape = (nr_extended, nr_facilities). They start with the listed facilities.
+        full_row (np.array): row of each agent in full_pref_list, -1 if the agent was not extended.
+        extend (bool): whether to stop at agents that run out of listed options, so that their list can be extended.
+
+    Returns:
+        int: position in the lottery of the agent to extend, or len(lottery) if all agents had their turn.
+    """
+    for i in range(start, len(lottery)):
+        agent = lottery[i]
+        prefs = full_pref_list[full_row[agent]] if full_row[agent] >= 0 else pref_list[agent]
+        for facility in prefs:
+            if facility >= 0 and remaining_capacity[facility] > 0:
+                assignments[agent] = facility
+                remaining_capacity[facility] -= 1
+                break
+        if extend and assignments[agent] < 0 and full_row[agent] < 0:
+            return i
+    return len(lottery)
+
+if njit is not None:
+    # Cached on disk, so that it is only compiled once and not again in every process (e.g. of the sensitivity analysis).
+    _serial_dictatorship = njit(nogil=True, cache=True)(_serial_dictatorship)
+else:
+    _serial_dictatorship = None
+
+def random_serial_dictatorship(pref_list, capacities, extend_preferences=None, rng=None, lottery=None):
     """Returns a matching where each agent is assigned a facility according to random serial dictatorship
     In random serial dictatorship (RSD), agents arrive randomly and are assigned top available preferred facility.
     Availability is determined by capacity of the facility at the time of the assignment.
 
+    Instead of going through the agents one by one, agents are assigned in blocks: every agent points to its top available facility, and all agents up to
+    (not including) the first one in the lottery that would exceed a capacity get their pick at once. Only then a facility fills up and the pointers move,
+    so the number of blocks is at most the number of facilities, and the matching is exactly the one-by-one matching for the same lottery.
+    If numba is installed, the one-by-one matching runs compiled instead, which is faster still (one pass over the lottery, no per-block sorting).
+    Agents that find no seat left in their (extended) list, e.g. when there are fewer seats than agents, stay unassigned (-1) - with or without extend_preferences.
+    The evaluation leaves them out of the per-agent metrics (see evaluation.evaluate_allocations).
+
+    Args:
+        pref_list (np.array): the preference list, shape = (nr_agents, nr_preferences)
+        capacities (np.array): the capacities of the facilities - the assigned seats are subtracted in place.
+        extend_preferences (callable, optional): for truncated preference lists - called with an agent id when all facilities in its list are full, should return the full preference list of the agent. Defaults to None.
+        rng (np.random.Generator, optional): random generator to draw the lottery with. Defaults to None (numpy's global random state).
+        lottery (np.array, optional): order in which the agents pick (a permutation of the agent ids). If given, rng is not used. Defaults to None.
+
+    Returns:
+        np.array: facility indices of the assigned facility per agent (-1 if the agent could not be assigned)
+    """
+    pref_list = np.asarray(pref_list)
+    nr_agents = pref_list.shape[0]
+    nr_facilities = len(capacities)
+    if lottery is None:
+        lottery = (rng.permutation(nr_agents) if rng is not None else np.random.permutation(nr_agents)).astype(np.int32)
+
+    assignments = np.full(nr_agents, -1, dtype=facility_index_dtype(nr_facilities))
+    if _serial_dictatorship is not None:
+        remaining_capacity = np.asarray(capacities, dtype=np.int64).copy()
+        pref_list, lottery = np.ascontiguousarray(pref_list), np.asarray(lottery)
+        # Full lists of the agents that ran out of (listed) options, one row per extended agent - grown as needed, so the whole preference list is not padded.
+        full_pref_list = np.empty((16, nr_facilities), dtype=pref_list.dtype)
+        full_row = np.full(nr_agents, -1, dtype=np.int32)
+        nr_extended = 0
+        i = _serial_dictatorship(pref_list, lottery, 0, remaining_capacity, assignments, full_pref_list, full_row, extend_preferences is not None)
+        while i < nr_agents:
+            if nr_extended == len(full_pref_list):
+                full_pref_list = np.concatenate([full_pref_list, np.empty_like(full_pref_list)])
+            agent = lottery[i]
+            full_pref_list[nr_extended] = extend_preferences(agent)
+            full_row[agent] = nr_extended
+            nr_extended += 1
+            i = _serial_dictatorship(pref_list, lottery, i, remaining_capacity, assignments, full_pref_list, full_row, True)
+    else:
+        # Position in the preference list of the top available facility of each agent.
+        next_choice = np.zeros(nr_agents, dtype=np.int32)
+        remaining_capacity = np.asarray(capacities, dtype=np.int64).copy()
+        is_full = remaining_capacity <= 0
+        extended = np.zeros(nr_agents, dtype=bool)
+        # Agents that still have to pick (in lottery order) and their current pick (-1 if they ran out of (listed) options).
+        waiting = np.asarray(lottery)
+        choice = np.full(len(waiting), -1, dtype=facility_index_dtype(nr_facilities))
+        to_move = np.arange(len(waiting))
+        while True:
+            # Move the pointers of the agents whose current pick is full.
+            while len(to_move) > 0:
+                agents = waiting[to_move]
+                in_list = next_choice[agents] < pref_list.shape[1]
+                choice[to_move[~in_list]] = -1
+                to_move, agents = to_move[in_list], agents[in_list]
+                choice[to_move] = pref_list[agents, next_choice[agents]]
+                blocked = (choice[to_move] >= 0) & is_full[choice[to_move]]
+                next_choice[agents[blocked]] += 1
+                to_move = to_move[blocked]
+
+            out_of_options = choice < 0
+            if extend_preferences is not None and (out_of_options & ~extended[waiting]).any():
+                # Agents that ran out of (listed) options continue with their full list - the first facilities are full anyway.
+                if pref_list.shape[1] < nr_facilities:
+                    pref_list = np.concatenate([pref_list, np.full((nr_agents, nr_facilities - pref_list.shape[1]), -1, dtype=pref_list.dtype)], axis=1)
+                to_move = np.flatnonzero(out_of_options & ~extended[waiting])
+                for agent in waiting[to_move]:
+                    pref_list[agent] = extend_preferences(agent)
+                    extended[agent] = True
+                continue
+            waiting, choice = waiting[~out_of_options], choice[~out_of_options]
+            if len(waiting) == 0:
+                break
+
+            # Position of each agent in the queue of its pick (in lottery order), with a stable (radix) sort by facility.
+            by_facility = np.argsort(choice, kind='stable')
+            sorted_choice = choice[by_facility]
+            queue_start = np.cumsum(np.bincount(choice, minlength=nr_facilities)) - np.bincount(choice, minlength=nr_facilities)
+            queue_pos = np.arange(len(waiting)) - queue_start[sorted_choice]
+            # The first agent in the lottery that does not fit anymore - everyone before it gets their pick.
+            overflow = by_facility[queue_pos >= remaining_capacity[sorted_choice]]
+            if len(overflow) == 0:
+                assignments[waiting] = choice
+                remaining_capacity -= np.bincount(choice, minlength=nr_facilities)
+                break
+            block_end = overflow.min()
+
+            assignments[waiting[:block_end]] = choice[:block_end]
+            remaining_capacity -= np.bincount(choice[:block_end], minlength=nr_facilities)
+            is_full = remaining_capacity <= 0
+            waiting, choice = waiting[block_end:], choice[block_end:]
+            to_move = np.flatnonzero(is_full[choice])
+
+    np.subtract(capacities, np.bincount(assignments[assignments >= 0], minlength=nr_facilities), out=capacities, casting='unsafe')
+    return assignments.reshape(-1, 1)
+
+def random_serial_dictatorship_batch(pref_list, capacities, nr_lotteries, extend_preferences=None, rng=None, lotteries=None, n_jobs=1, rngs=None):
+    """Runs random serial dictatorship for several lotteries on the same preferences, e.g. all allocation rounds of a simulation round at once.
+
     Args:
         pref_list (np.array): the preference list, shape = (nr_agents, nr_preferences)
+        capacities (np.array): the capacities of the facilities (not modified).
+        nr_lotteries (int): nr of lotteries (allocations) to run.
+        extend_preferences (callable, optional): see random_serial_dictatorship. Defaults to None.
+        rng (np.random.Generator, optional): random generator to draw the lotteries with. Defaults to None (numpy's global random state).
+        lotteries (np.array, optional): the lotteries to use, shape = (nr_lotteries, nr_agents). If given, rng is not used. Defaults to None.
+        n_jobs (int, optional): nr of threads to spread the lotteries over. Defaults to 1.
+        rngs (list, optional): one random generator per lottery, each lottery is drawn (by its worker) from its own generator, so the results don't depend on n_jobs. Overrides rng. Defaults to None.
+
+    Returns:
+        np.array: facility indices of the assigned facility per agent for each lottery, shape = (nr_lotteries, nr_agents)
+    """
+    pref_list = np.asarray(pref_list)
+    if rngs is not None:
+        assert len(rngs) == nr_lotteries, "Need one random generator per lottery."
+    elif lotteries is None:
+        lotteries = np.array([rng.permutation(len(pref_list)) if rng is not None else np.random.permutation(len(pref_list)) for _ in range(nr_lotteries)], dtype=np.int32)
+    # Remaining capacity of each lottery - every lottery fills its own row.
+    remaining_capacities = np.tile(np.asarray(capacities), (nr_lotteries, 1))
+
+    def allocate(r):
+        if lotteries is None:
+            return random_serial_dictatorship(pref_list, remaining_capacities[r], extend_preferences=extend_preferences, rng=rngs[r])[:, 0]
+        return random_serial_dictatorship(pref_list, remaining_capacities[r], extend_preferences=extend_preferences, lottery=lotteries[r])[:, 0]
+
+    if n_jobs > 1:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            allocations = list(executor.map(allocate, range(nr_lotteries)))
+    else:
+        allocations = [allocate(r) for r in range(nr_lotteries)]
+
+    return np.stack(allocations)
+
+def probabilistic_serial(pref_list, capacities, class_sizes, extend_preferences=None):
+    """Returns the expected assignment of the Probabilistic Serial (eating) mechanism, a deterministic surrogate for the average over many RSD lotteries.
+    All agents "eat" their top available facility at the same speed, from time 0 to 1. When a facility runs out of capacity, its agents move on to their next one.
+    The time an agent spent eating a facility is its probability of being assigned to it.
+    Agents with identical preferences get identical probabilities, so this runs on classes of agents (with their sizes as eating speed). The nr of steps is at most the nr of facilities.
+
+    Args:
+        pref_list (np.array): the preference list of each class, shape = (nr_classes, nr_preferences)
         capacities (np.array): the capacities of the facilities
+        class_sizes (np.array): nr of agents in each class (ones for a per-agent preference list).
+        extend_preferences (callable, optional): for truncated preference lists - called with a class id when all facilities in its list are full, should return the full preference list of the class. Defaults to None.
+
+    Returns:
+        np.array: assignment probabilities of an agent of each class to each facility, shape = (nr_classes, nr_facilities). Rows sum to less than 1 if capacities run out.
+    """
+    pref_list = np.asarray(pref_list)
+    class_sizes = np.asarray(class_sizes, dtype=float)
+    nr_classes = pref_list.shape[0]
+    nr_facilities = len(capacities)
+    remaining_capacity = np.asarray(capacities, dtype=float).copy()
+    # Capacities are floats here, so a facility is full once (almost) nothing is left.
+    eps = 1e-9
+    is_full = remaining_capacity <= eps
+
+    probabilities = np.zeros((nr_classes, nr_facilities))
+    next_choice = np.zeros(nr_classes, dtype=np.int32)
+    extended = np.zeros(nr_classes, dtype=bool)
+    eating = np.arange(nr_classes)
+    time = 0
+    while time < 1 - eps:
+        # Move the classes whose current facility is full to their next one (-1 if they ran out of options).
+        choice = np.full(len(eating), -1, dtype=np.int32)
+        to_move = np.arange(len(eating))
+        while len(to_move) > 0:
+            classes = eating[to_move]
+            in_list = next_choice[classes] < pref_list.shape[1]
+            choice[to_move[~in_list]] = -1
+            to_move, classes = to_move[in_list], classes[in_list]
+            choice[to_move] = pref_list[classes, next_choice[classes]]
+            blocked = (choice[to_move] >= 0) & is_full[choice[to_move]]
+            next_choice[classes[blocked]] += 1
+            to_move = to_move[blocked]
+
+        out_of_options = choice < 0
+        if extend_preferences is not None and (out_of_options & ~extended[eating]).any():
+            if pref_list.shape[1] < nr_facilities:
+                pref_list = np.concatenate([pref_list, np.full((nr_classes, nr_facilities - pref_list.shape[1]), -1, dtype=pref_list.dtype)], axis=1)
+            for c in eating[out_of_options & ~extended[eating]]:
+                pref_list[c] = extend_preferences(c)
+                extended[c] = True
+            continue
+        eating, choice = eating[~out_of_options], choice[~out_of_options]
+        if len(eating) == 0:
+            break
+
+        # Eat until the next facility runs out (or time is up).
+        speed = np.bincount(choice, weights=class_sizes[eating], minlength=nr_facilities)
+        being_eaten = speed > 0
+        step = min((remaining_capacity[being_eaten] / speed[being_eaten]).min(), 1 - time)
+
+        probabilities[eating, choice] += step
+        remaining_capacity -= speed * step
+        is_full = remaining_capacity <= eps
+        time += step
+
+    return probabilities
+
+def _draw_tie_breaking(nr_agents, nr_facilities, tie_breaking, rng=None):
+    """Internal helper function that draws the lottery numbers used to break ties in the facility priorities (lower is better).
+
+    Args:
+        nr_agents (int): nr of agents.
+        nr_facilities (int): nr of facilities.
+        tie_breaking (str): 'single' - one lottery for all facilities, 'multiple' - an independent lottery per facility.
+        rng (np.random.Generator, optional): random generator to draw the lottery with. Defaults to None (numpy's global random state).
+
+    Returns:
+        np.array: lottery numbers, shape = (nr_agents, ) for single and (nr_agents, nr_facilities) for multiple tie breaking.
+    """
+    assert tie_breaking in ['single', 'multiple'], f'Unknown tie_breaking {tie_breaking}, applicable values: single, multiple.'
+    shape = nr_agents if tie_breaking == 'single' else (nr_agents, nr_facilities)
+    return rng.random(shape) if rng is not None else np.random.random(shape)
+
+def deferred_acceptance(pref_list, capacities, priorities=None, tie_breaking='single', extend_preferences=None, rng=None):
+    """Returns the matching of (agent-proposing) deferred acceptance, where facilities rank the agents by priority and break ties with a lottery.
+    Every round, all agents without a facility propose to the next facility on their list, and each facility keeps the (at most capacity) best agents
+    out of the ones it holds and the new proposals. The rounds run on flat arrays, only for the facilities that received proposals.
+    Agents that are rejected by every facility in their (extended) list, e.g. when there are fewer seats than agents, stay unassigned (-1), same as in random_serial_dictatorship.
+
+    Args:
+        pref_list (np.array): the preference list, shape = (nr_agents, nr_preferences)
+        capacities (np.array): the capacities of the facilities - the assigned seats are subtracted in place.
+        priorities (np.array, optional): priority of each agent at each facility (lower is better), shape = (nr_agents, nr_facilities). Defaults to None (lottery only).
+        tie_breaking (str, optional): 'single' - one lottery for all facilities, 'multiple' - an independent lottery per facility. Defaults to 'single'.
+        extend_preferences (callable, optional): for truncated preference lists - called with an agent id when it was rejected by all facilities in its list, should return the full preference list of the agent. Defaults to None.
+        rng (np.random.Generator, optional): random generator to draw the lottery with. Defaults to None (numpy's global random state).
+
+    Returns:
+        np.array: facility indices of the assigned facility per agent (-1 if the agent could not be assigned)
+    """
+    pref_list = np.asarray(pref_list)
+    nr_agents = pref_list.shape[0]
+    nr_facilities = len(capacities)
+    lottery = _draw_tie_breaking(nr_agents, nr_facilities, tie_breaking, rng)
+
+    def priority_keys(agents, facilities):
+        # Sort keys of (agent, facility) pairs for np.lexsort, last key is the primary one.
+        keys = [lottery[agents] if lottery.ndim == 1 else lottery[agents, facilities]]
+        if priorities is not None:
+            keys.append(priorities[agents, facilities])
+        return keys
+
+    assignments = np.full(nr_agents, -1, dtype=facility_index_dtype(nr_facilities))
+    next_choice = np.zeros(nr_agents, dtype=np.int32)
+    extended = np.zeros(nr_agents, dtype=bool)
+    proposing = np.arange(nr_agents)
+    while True:
+        # Agents past the end of their list (or at the -1 padding of a list that was not extended) are out of options.
+        in_list = next_choice[proposing] < pref_list.shape[1]
+        in_list[in_list] = pref_list[proposing[in_list], next_choice[proposing[in_list]]] >= 0
+        exhausted = proposing[~in_list & ~extended[proposing]]
+        if extend_preferences is not None and len(exhausted) > 0:
+            if pref_list.shape[1] < nr_facilities:
+                pref_list = np.concatenate([pref_list, np.full((nr_agents, nr_facilities - pref_list.shape[1]), -1, dtype=pref_list.dtype)], axis=1)
+            for agent in exhausted:
+                pref_list[agent] = extend_preferences(agent)
+                extended[agent] = True
+            continue
+        proposing = proposing[in_list]
+        if len(proposing) == 0:
+            break
+
+        # Facilities with new proposals re-select from the agents they hold and the new proposals.
+        proposed_to = pref_list[proposing, next_choice[proposing]]
+        has_proposals = np.zeros(nr_facilities, dtype=bool)
+        has_proposals[proposed_to] = True
+        held = np.flatnonzero(assignments >= 0)
+        held = held[has_proposals[assignments[held]]]
+        agents = np.concatenate([held, proposing])
+        facilities = np.concatenate([assignments[held], proposed_to])
+        order = np.lexsort(priority_keys(agents, facilities) + [facilities])
+        agents, facilities = agents[order], facilities[order]
+        # Position of each agent in the queue of its facility.
+        queue_start = np.searchsorted(facilities, facilities)
+        accepted = np.arange(len(agents)) - queue_start < capacities[facilities]
+
+        assignments[agents[accepted]] = facilities[accepted]
+        rejected = agents[~accepted]
+        assignments[rejected] = -1
+        next_choice[rejected] += 1
+        proposing = rejected
+
+    np.subtract(capacities, np.bincount(assignments[assignments >= 0], minlength=nr_facilities), out=capacities, casting='unsafe')
+    return assignments.reshape(-1, 1)
+
+def top_trading_cycles(pref_list, capacities, priorities=None, tie_breaking='single', extend_preferences=None, rng=None):
+    """Returns the matching of top trading cycles (TTC), where facilities rank the agents by priority and break ties with a lottery.
+    Every round, each agent points to its top facility with seats left and each facility points to its highest priority agent that is left.
+    Agents on a cycle get the facility they point to. Each facility keeps a queue of the agents by priority and each agent a position in its list, so pointing
+    is a pointer move. Cycles are found by following the pointers from an agent until the path closes, and the rest of the path is re-used for the next cycle,
+    so every pointer moves O(nr_agents * nr_preferences + nr_agents * nr_facilities) times in total instead of re-scanning all agents every round.
+    With a single lottery and no priorities all facilities point to the same agent, and TTC is the same as random serial dictatorship, which is used then.
+    Agents that run out of facilities with seats left, e.g. when there are fewer seats than agents, stay unassigned (-1) - with or without priorities.
+
+    Args:
+        pref_list (np.array): the preference list, shape = (nr_agents, nr_preferences)
+        capacities (np.array): the capacities of the facilities - the assigned seats are subtracted in place.
+        priorities (np.array, optional): priority of each agent at each facility (lower is better), shape = (nr_agents, nr_facilities). Defaults to None (lottery only).
+        tie_breaking (str, optional): 'single' - one lottery for all facilities, 'multiple' - an independent lottery per facility. Defaults to 'single'.
+        extend_preferences (callable, optional): for truncated preference lists - called with an agent id when all facilities in its list are full, should return the full preference list of the agent. Defaults to None.
+        rng (np.random.Generator, optional): random generator to draw the lottery with. Defaults to None (numpy's global random state).
 
     Returns:
-        np.array: facility indices of the assigned facility per agent
+        np.array: facility indices of the assigned facility per agent (-1 if the agent could not be assigned)
     """
-    assignments = np.empty([len(pref_list), 1])
+    pref_list = np.asarray(pref_list)
+    nr_agents = pref_list.shape[0]
+    nr_facilities = len(capacities)
+    lottery = _draw_tie_breaking(nr_agents, nr_facilities, tie_breaking, rng)
+    if priorities is None and lottery.ndim == 1:
+        return random_serial_dictatorship(pref_list, capacities, extend_preferences=extend_preferences, lottery=np.argsort(lottery))
+
+    # Queue of the agents of each facility by priority - (nr_facilities, nr_agents), and the position of the agent each facility points to.
+    queues = np.empty((nr_facilities, nr_agents), dtype=np.int64)
+    for f in range(nr_facilities):
+        keys = [lottery if lottery.ndim == 1 else lottery[:, f]]
+        if priorities is not None:
+            keys.append(priorities[:, f])
+        queues[f] = np.lexsort(keys)
+    queues = queues.tolist()
+    queue_pos = [0] * nr_facilities
+
+    pref_rows = pref_list.tolist()
+    assignments = np.full(nr_agents, -1, dtype=facility_index_dtype(nr_facilities))
+    remaining_capacity = np.asarray(capacities, dtype=np.int64).tolist()
+    is_left = [True] * nr_agents
+    next_choice = [0] * nr_agents
+    extended = [False] * nr_agents
 
-    lottery = list(range(len(pref_list)))
-    random.shuffle(lottery)
+    def target(agent):
+        # Top facility with seats left of the agent (-1 if it ran out of options). Pointers only move forward, each entry of the list is passed once.
+        row = pref_rows[agent]
+        while True:
+            k = next_choice[agent]
+            if k < len(row) and row[k] >= 0:
+                if remaining_capacity[row[k]] > 0:
+                    return row[k]
+                next_choice[agent] = k + 1
+            elif extend_preferences is not None and not extended[agent]:
+                # Resume in the full list at the same position - the listed facilities are a prefix of it.
+                row = pref_rows[agent] = [int(f) for f in extend_preferences(agent)]
+                extended[agent] = True
+            else:
+                return -1
 
-    for agent in lottery:
-        for facility in pref_list[agent]:
-            if capacities[facility] > 0:
-                assignments[agent] = np.array([facility])
-                capacities[facility] -= 1
+    def top_agent(facility):
+        # Highest priority agent of the facility that is left, the queue pointer only moves forward.
+        queue, pos = queues[facility], queue_pos[facility]
+        while not is_left[queue[pos]]:
+            pos += 1
+        queue_pos[facility] = pos
+        return queue[pos]
+
+    # Chase pointers agent -> facility -> agent along a path (stack) until it closes a cycle, trade the cycle and continue from the rest of the path.
+    # Path entries stay valid until the facility they point to fills up, so the path is only cut back then.
+    path, path_facilities, path_pos = [], [], {}
+    start = 0
+    while True:
+        if not path:
+            while start < nr_agents and not is_left[start]:
+                start += 1
+            if start == nr_agents:
                 break
-    
-    # this is done to reset the shuffle of the lottery. (python stuff)
-    del lottery
-    assert len(np.unique(assignments)) <= len(np.unique(pref_list)), 'Some agents were not assigned and this should not happen, or we should take care of it.'
+            path.append(start)
+            path_pos[start] = 0
+        agent = path[-1]
+        facility = target(agent)
+        if facility < 0:
+            # Agents without options leave unassigned.
+            is_left[agent] = False
+            path.pop()
+            del path_pos[agent]
+            if path_facilities:
+                path_facilities.pop()
+            continue
+        path_facilities.append(facility)
+        successor = top_agent(facility)
+        if successor not in path_pos:
+            path_pos[successor] = len(path)
+            path.append(successor)
+            continue
+
+        # Cycle from successor to the end of the path.
+        cycle_start = path_pos[successor]
+        filled = False
+        for cycle_agent, cycle_facility in zip(path[cycle_start:], path_facilities[cycle_start:]):
+            assignments[cycle_agent] = cycle_facility
+            is_left[cycle_agent] = False
+            del path_pos[cycle_agent]
+            remaining_capacity[cycle_facility] -= 1
+            filled = filled or remaining_capacity[cycle_facility] == 0
+        del path[cycle_start:], path_facilities[cycle_start:]
+        # The last agent on the path pointed into the cycle, it has to re-point.
+        if path_facilities:
+            path_facilities.pop()
+        if filled:
+            # Cut the path back to the first agent that points to a facility that is full now.
+            full = [i for i, f in enumerate(path_facilities) if remaining_capacity[f] <= 0]
+            if full:
+                for cut_agent in path[full[0] + 1:]:
+                    del path_pos[cut_agent]
+                del path[full[0] + 1:], path_facilities[full[0]:]
+
+    np.subtract(capacities, np.bincount(assignments[assignments >= 0], minlength=nr_facilities), out=capacities, casting='unsafe')
+    return assignments.reshape(-1, 1)
+
+def random_serial_dictatorship_counts(pref_list, capacities, class_sizes, extend_preferences=None, rng=None):
+    """Random serial dictatorship on classes of agents with identical preferences, returning how many agents of each class get each facility.
+    RSD only changes course when a facility fills up. Until then, every arriving agent gets the current pick of its class. The lottery is a random order
+    of the class labels, so the class counts of any prefix of it are multivariate hypergeometric. The arrival at which the next facility fills up is found by
+    bisection, sampling the counts of each half of an interval given the counts of the whole interval. Every facility that fills up costs O(log(nr_agents))
+    samples of size nr_classes, so the cost does not depend on the nr of agents per class.
+
+    Args:
+        pref_list (np.array): the preference list of each class, shape = (nr_classes, nr_preferences)
+        capacities (np.array): the capacities of the facilities (not modified).
+        class_sizes (np.array): nr of agents in each class.
+        extend_preferences (callable, optional): for truncated preference lists - called with a class id when all facilities in its list are full, should return the full preference list of the class. Defaults to None.
+        rng (np.random.Generator, optional): random generator to sample the lottery with. Defaults to None (seeded from numpy's global random state).
+
+    Returns:
+        np.array: nr of agents of each class assigned to each facility, shape = (nr_classes, nr_facilities). Agents that could not be assigned are not counted.
+    """
+    if rng is None:
+        rng = np.random.default_rng(np.random.randint(2**31))
+    pref_list = np.asarray(pref_list)
+    nr_classes = pref_list.shape[0]
+    nr_facilities = len(capacities)
+    remaining_capacity = np.asarray(capacities, dtype=np.int64).copy()
+    # Agents of each class that did not arrive yet.
+    waiting = np.asarray(class_sizes, dtype=np.int64).copy()
+
+    counts = np.zeros((nr_classes, nr_facilities), dtype=np.int64)
+    next_choice = np.zeros(nr_classes, dtype=np.int32)
+    extended = np.zeros(nr_classes, dtype=bool)
+    choice = np.full(nr_classes, -1, dtype=np.int32)
+    to_move = np.arange(nr_classes)
+    while True:
+        # Move the classes whose current pick is full (-1 if they ran out of options).
+        while len(to_move) > 0:
+            in_list = next_choice[to_move] < pref_list.shape[1]
+            choice[to_move[~in_list]] = -1
+            to_move = to_move[in_list]
+            choice[to_move] = pref_list[to_move, next_choice[to_move]]
+            blocked = (choice[to_move] >= 0) & (remaining_capacity[choice[to_move]] <= 0)
+            next_choice[to_move[blocked]] += 1
+            to_move = to_move[blocked]
+
+        out_of_options = (choice < 0) & (waiting > 0)
+        if extend_preferences is not None and (out_of_options & ~extended).any():
+            if pref_list.shape[1] < nr_facilities:
+                pref_list = np.concatenate([pref_list, np.full((nr_classes, nr_facilities - pref_list.shape[1]), -1, dtype=pref_list.dtype)], axis=1)
+            to_move = np.flatnonzero(out_of_options & ~extended)
+            pref_list[to_move] = [extend_preferences(c) for c in to_move]
+            extended[to_move] = True
+            continue
+        # Classes without options don't take any seats, their arrivals can be left out of the lottery.
+        waiting[out_of_options] = 0
+        if waiting.sum() == 0:
+            break
+
+        def fills_up(prefix):
+            # Whether some facility is full after the arrivals with these class counts.
+            demand = np.bincount(choice[prefix > 0], weights=prefix[prefix > 0], minlength=nr_facilities)
+            return ((demand > 0) & (demand >= remaining_capacity)).any()
+
+        if not fills_up(waiting):
+            # Nothing fills up anymore, everyone gets their current pick.
+            np.add.at(counts, (np.flatnonzero(waiting), choice[waiting > 0]), waiting[waiting > 0])
+            break
+
+        # Bisection on the arrival at which the first facility fills up: prefix lo doesn't fill any facility, prefix hi does.
+        lo, lo_counts = 0, np.zeros(nr_classes, dtype=np.int64)
+        hi, hi_counts = waiting.sum(), waiting.copy()
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            mid_counts = lo_counts + rng.multivariate_hypergeometric(hi_counts - lo_counts, mid - lo)
+            if fills_up(mid_counts):
+                hi, hi_counts = mid, mid_counts
+            else:
+                lo, lo_counts = mid, mid_counts
+
+        # All arrivals up to the one that fills the facility get their pick.
+        arrived = np.flatnonzero(hi_counts)
+        np.add.at(counts, (arrived, choice[arrived]), hi_counts[arrived])
+        remaining_capacity -= np.bincount(choice[arrived], weights=hi_counts[arrived], minlength=nr_facilities).astype(np.int64)
+        waiting -= hi_counts
+        to_move = np.flatnonzero(remaining_capacity[np.maximum(choice, 0)] <= 0)
 
-    return assignments.astype(int)
+    return counts
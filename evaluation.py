@@ -1,4 +1,6 @@
 import numpy as np
+import pandas as pd
+from preference import preference_ranks
 
 def calculate_ci(array: np.array, z=1.96):
     """Calculates the mean, standard error, and confidence interval of the given array.
@@ -16,6 +18,39 @@ def calculate_ci(array: np.array, z=1.96):
     se = std/np.sqrt(array.shape[0])
     return m, m - z * se, m + z * se
 
+def is_fractional(allocation):
+    """Returns whether the allocation is fractional (expected) - array of shape (total_pop, nr_facilities) with the probability of each agent to be allocated to each facility, e.g. from probabilistic_serial -
+    instead of array of shape (total_pop, 1) with the facility of each agent.
+
+    Args:
+        allocation (np.array): the allocation.
+
+    Returns:
+        bool: whether the allocation is fractional (float dtype).
+    """
+    return np.issubdtype(allocation.dtype, np.floating)
+
+def _allocated_values(values, allocation):
+    """Internal helper function that gathers the value of the allocated facility of each agent (expected value for fractional allocations), without the unassigned agents.
+    Unassigned agents (-1, or the missing probability of a fractional allocation whose row sums to less than 1) get value 0 and assigned share 0,
+    so that value.sum() / assigned.sum() is the mean over the assigned agents.
+
+    Args:
+        values (np.array): value of each facility for each agent, e.g. travel time, preference rank or utility - shape = (total_pop, nr_facilities)
+        allocation (np.array): array of shape (total_pop, 1) where each agent is allocated to 1 facility, or a fractional allocation (see is_fractional). Can have a leading nr_rounds axis.
+
+    Returns:
+        tuple: (value, assigned) - the (probability weighted) value of the allocated facility and the assigned share of each agent, shape = allocation.shape[:-1]
+    """
+    if is_fractional(allocation):
+        # Facilities the agent can't be allocated to don't count (even if unreachable).
+        return (np.where(allocation > 0, values, 0) * allocation).sum(axis=-1), allocation.sum(axis=-1)
+
+    facility = allocation[..., 0]
+    assigned = facility >= 0
+    value = np.where(assigned, values[np.arange(values.shape[0]), np.where(assigned, facility, 0)], 0)
+    return value, assigned.astype(float)
+
 def facility_rank_distribution(pref_list, total_facilities, return_avg_pos_by_fac=False):
     """Returns a numpy array of size (facility_size, max nr of preferences) where each element in the array is the number of agents that have that facility as their n-th preference.
 
@@ -27,11 +62,10 @@ def facility_rank_distribution(pref_list, total_facilities, return_avg_pos_by_fa
         - np.array: array of size (facility_size, max nr of preferences) where each element in the array is the number of agents that have that facility as their n-th preference.
         - np.array: (if return_avg_pos_by_fac is True) array of size (facility_size, 1) where each element is the average position of that facility in the preference list.
     """
-    # Don't know if we can speed this up, because preference lists can have -1 values for agents that don't have preferences over all facilities.
-    pref_position_by_facility = np.zeros((total_facilities, pref_list.shape[1]))
-    for i in range(total_facilities):
-        for j in range(pref_list.shape[1]):
-            pref_position_by_facility[i, j] = np.sum(pref_list[:, j] == i)
+    # Count all (facility, position) pairs in one pass, with facility * nr_preferences + position as bin. Preference lists can have -1 values for agents that don't have preferences over all facilities, those are left out.
+    valid = (pref_list >= 0) & (pref_list < total_facilities)
+    positions = np.nonzero(valid)[1]
+    pref_position_by_facility = np.bincount(pref_list[valid].astype(np.int64) * pref_list.shape[1] + positions, minlength=total_facilities * pref_list.shape[1]).reshape(total_facilities, pref_list.shape[1]).astype(float)
     
     if return_avg_pos_by_fac:
         avg_pos_by_fac = (pref_position_by_facility * np.arange(1, pref_position_by_facility.shape[1] + 1)).sum(axis=1)/pref_list.shape[0]
@@ -45,21 +79,24 @@ def facility_capacity(population, facilities, allocation, return_pct=True):
     Args:
         population (pd.DataFrame): population dataframe - should have id column
         facilities (pd.DataFrame): facility dataframe - should have id column
-        allocation (np.array): array of shape (total_pop, 1) where each agent is allocated to 1 facility.
+        allocation (np.array): array of shape (total_pop, 1) where each agent is allocated to 1 facility, or a fractional allocation (see is_fractional).
         return_pct (bool, optional): whether to return the percentage of filled capacity. Defaults to True.
 
     Returns:
         array: array of satisfied capacity per facility.
     """
     # TODO - probably best to transfer this assert to the allocation method.
-    assert allocation.shape[1] == 1, 'Only one facility should be allocated to each agent.'
+    assert allocation.shape[1] == 1 or is_fractional(allocation), 'Only one facility should be allocated to each agent.'
     
-    alloc_by_facility = []
-    capacity_pct = []
-    for fid in facilities['id'].values:
-        allocs = np.sum(allocation == fid)
-        alloc_by_facility.append(allocs)
-        capacity_pct.append(allocs / facilities.loc[facilities['id'] == fid]['capacity'].values[0])
+    fids = facilities['id'].values
+    if is_fractional(allocation):
+        # Expected nr of agents for fractional allocations.
+        alloc_by_facility = allocation[:, fids].sum(axis=0)
+    else:
+        # Unassigned agents (-1) are not counted.
+        assigned = allocation[allocation >= 0]
+        alloc_by_facility = np.bincount(assigned, minlength=max(facilities.shape[0], fids.max() + 1))[fids]
+    capacity_pct = alloc_by_facility / facilities['capacity'].values
 
     if return_pct:
         return alloc_by_facility, capacity_pct
@@ -71,9 +108,9 @@ def facility_group_composition(population, facilities, allocation, return_pct=Tr
     If return_pct is True, returns another 2-D array with the percentage of agents of each group in each facility.
 
     Args:
-        population (pd.DataFrame): population dataframe - should have id column
+        population (pd.DataFrame): population dataframe - should have id column. Can also be the agent classes, with the (float) nr of agents of each class in each facility as allocation (see random_serial_dictatorship_counts).
         facilities (pd.DataFrame): facility dataframe - should have id column
-        allocation (np.array): array of shape (total_pop, 1) where each agent is allocated to 1 facility.
+        allocation (np.array): array of shape (total_pop, 1) where each agent is allocated to 1 facility, or a fractional allocation (see is_fractional).
         return_pct (bool, optional): whether to return the percentage of each group in each facility. Defaults to True.
 
     Returns:
@@ -81,16 +118,21 @@ def facility_group_composition(population, facilities, allocation, return_pct=Tr
         - list: (if return_pct is True) [allocated agents of per group per facility, percentage of each group in each facility].
     """
     # TODO - probably best to transfer this assert to the allocation method.
-    assert allocation.shape[1] == 1, 'Only one facility should be allocated to each agent.'
-
-    # I don't like the for-based solution but too lazy atm.
-    alloc_by_facility = np.zeros((facilities.shape[0], population['group'].nunique()))
-    for gid, g in enumerate(population['group'].unique()):
-        pop_id = population[population['group'] == g]['id'].values
+    assert allocation.shape[1] == 1 or is_fractional(allocation), 'Only one facility should be allocated to each agent.'
 
-        for fid in facilities['id'].values:
-            allocs = np.sum(allocation[pop_id] == fid)
-            alloc_by_facility[fid, gid] = allocs
+    # Groups are in sorted order (same as group_id in the Runner), so that the columns don't depend on the order of the population rows.
+    group_codes, groups = pd.factorize(population['group'].values, sort=True)
+    fids = facilities['id'].values
+    allocation = allocation[population['id'].values]
+    alloc_by_facility = np.zeros((facilities.shape[0], len(groups)))
+    if is_fractional(allocation):
+        # Expected nr of agents of the group in each facility - (one-hot groups).T @ allocation.
+        alloc_by_facility[fids] = (np.eye(len(groups))[group_codes].T @ allocation[:, fids]).T
+    else:
+        # Count all (facility, group) pairs in one pass, with facility * nr_groups + group as bin. Unassigned agents (-1) are not counted.
+        assigned = allocation[:, 0] >= 0
+        counts = np.bincount(allocation[assigned, 0].astype(np.int64) * len(groups) + group_codes[assigned], minlength=max(facilities.shape[0], fids.max() + 1) * len(groups)).reshape(-1, len(groups))
+        alloc_by_facility[fids] = counts[fids]
 
     if return_pct:
         # In this particular division, we don't want to get a warning for division by 0, it just means that the facility is empty and nan is fine.
@@ -109,7 +151,7 @@ def dissimilarity_index(population, facilities, allocation, group_composition=No
     Args:
         population (pd.DataFrame): population dataframe - should have id column
         facilities (pd.DataFrame): facility dataframe - should have id column
-        allocation (np.array): array of shape (total_pop, 1) where each agent is allocated to 1 facility.
+        allocation (np.array): array of shape (total_pop, 1) where each agent is allocated to 1 facility, or a fractional allocation (see is_fractional).
         group_composition (np.array, optional): if given, it will not call facility_group_composition to re-calculate it . Defaults to None.
 
     Returns:
@@ -121,60 +163,164 @@ def dissimilarity_index(population, facilities, allocation, group_composition=No
 
     A = group_composition[:, 0].sum()
     B = group_composition[:, 1].sum()
-    DI = 0
-    for fid in range(facilities.shape[0]):
-        a = group_composition[fid, 0]
-        b = group_composition[fid, 1]
-        DI += np.abs(a/A - b/B)
+    DI = np.abs(group_composition[:, 0]/A - group_composition[:, 1]/B).sum()
     
     return 1/2 * DI
 
-def travel_time_to_allocation(tt_mx, population, facilities, allocation, return_group_avg=False, groups=None):
+def travel_time_to_allocation(travel_time, population, facilities, allocation, return_group_avg=False, groups=None):
     """Calculates the average travel time of of each agent (and group) to each allocated facility.
     
     Args:
-        tt_mx (np.array): travel time matrix - shape = (nodes_nr, nodes_nr)
+        travel_time (np.array): travel time from each agent to each facility - shape = (total_pop, nr_facilities), e.g. from Network.travel_times
         population (pd.DataFrame): population dataframe - should have id column
         groups (list): list of groups
         facilities (pd.DataFrame): facility dataframe - should have id column
-        allocation (np.array): array of shape (total_pop, 1) where each agent is allocated to 1 facility.
+        allocation (np.array): array of shape (total_pop, 1) where each agent is allocated to 1 facility, or a fractional allocation (see is_fractional).
         return_group_avg (bool, optional): whether to return the average travel time of each group. Defaults to False.
+
+    Returns:
+        float: average travel time of the assigned agents (unassigned agents are left out, nan if no agent is assigned).
+        np.array: (if return_group_avg is True) average travel time of the assigned agents of each group.
     """
+    tt_to_alloc, assigned = _allocated_values(travel_time, allocation)
 
-    tt_to_fac = tt_mx[population['node']][:, facilities['node']]
-    tt_to_alloc = tt_to_fac[np.arange(len(tt_to_fac)), allocation.flatten()]
-    
-    tt_to_alloc_mean = tt_to_alloc.mean()
-    if return_group_avg:
-        assert groups is not None, "To return group average travel time, you must provide the groups list."
+    # A group without assigned agents has no average travel time, nan is fine.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tt_to_alloc_mean = tt_to_alloc.sum() / assigned.sum()
+        if return_group_avg:
+            assert groups is not None, "To return group average travel time, you must provide the groups list."
 
-        tt_to_alloc_by_group_mean = np.array([tt_to_alloc[population.index[population['group_id'] == g]].mean() for g in groups.index])
+            group_idx = [population.index[population['group_id'] == g] for g in groups.index]
+            tt_to_alloc_by_group_mean = np.array([tt_to_alloc[idx].sum() / assigned[idx].sum() for idx in group_idx])
+    if return_group_avg:
         return tt_to_alloc_mean, tt_to_alloc_by_group_mean
     else:
         return tt_to_alloc_mean
 
 
-def preference_of_allocation(pref_list: np.array, allocation: np.array, return_group_avg=False, group_membership=None):
+def preference_of_allocation(pref_list: np.array, allocation: np.array, return_group_avg=False, group_membership=None, pref_ranks=None):
     """Calculates the average position of the allocated facility in the preference list of each agent (and/or group).
 
     Args:
-        pref_list (np.array): preference list - shape = (total_pop, nr_facilities)
-        allocation (np.array): array of shape (total_pop, 1) where each agent is allocated to 1 facility.
+        pref_list (np.array): preference list - shape = (total_pop, nr_preferences). For truncated lists, an allocation outside of the list counts as position nr_preferences.
+        allocation (np.array): array of shape (total_pop, 1) where each agent is allocated to 1 facility, or a fractional allocation (see is_fractional).
         return_group_avg (bool, optional): whether to return the average position of each group. Defaults to False.
         group_membership (_type_, optional): group of each agent - should have equal nr of rows with pref_list/allocation. Defaults to None.
+        pref_ranks (np.array, optional): rank matrix of pref_list (see preference.preference_ranks), computed if not given. Defaults to None.
 
     Returns:
-        float: average position of the allocated facility in the preference list of each agent.
-        np.array: (if return_group_avg is True) average position of each group in the preference list of each agent.
+        float: average position of the allocated facility in the preference list of the assigned agents (unassigned agents are left out).
+        np.array: (if return_group_avg is True) average position of each group in the preference list of its assigned agents.
     """
-    alloc_pos = np.where(pref_list == allocation)[1]
+    if pref_ranks is None:
+        nr_facilities = allocation.shape[1] if is_fractional(allocation) else max(pref_list.max(), allocation.max()) + 1
+        pref_ranks = preference_ranks(pref_list, nr_facilities)
 
-    if return_group_avg:
-        assert group_membership is not None, "To return group average preference position, you must provide the groups list."
-        assert group_membership.shape[0] == allocation.shape[0], "agent_group must be of the same length as allocation."
+    # Expected position for fractional allocations - position of every facility in the list of each agent, weighted by the allocation probabilities.
+    alloc_pos, assigned = _allocated_values(pref_ranks, allocation)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if return_group_avg:
+            assert group_membership is not None, "To return group average preference position, you must provide the groups list."
+            assert group_membership.shape[0] == allocation.shape[0], "agent_group must be of the same length as allocation."
+
+            alloc_pos_by_group = [alloc_pos[group_membership == g].sum() / assigned[group_membership == g].sum() for g in np.unique(group_membership)]
+
+            return alloc_pos.sum() / assigned.sum(), alloc_pos_by_group
+        else:
+            return alloc_pos.sum() / assigned.sum()
+
+def utility_of_allocation(utility, allocation):
+    """Returns the utility of each agent for its allocated facility (expected utility given that the agent is assigned, for fractional allocations).
+
+    Args:
+        utility (np.array): utility of each facility for each agent - shape = (total_pop, nr_facilities)
+        allocation (np.array): array of shape (total_pop, 1) where each agent is allocated to 1 facility, or a fractional allocation (see is_fractional).
+
+    Returns:
+        np.array: utility of each agent, nan for unassigned agents - shape = (total_pop, )
+    """
+    alloc_utility, assigned = _allocated_values(utility, allocation)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(assigned > 0, alloc_utility / assigned, np.nan)
 
-        alloc_pos_by_group = [alloc_pos[group_membership == g].mean() for g in np.unique(group_membership)]
+def evaluate_allocations(allocations, pref_list, travel_time, group_codes, capacities, nr_groups, utility=None, weights=None, pref_ranks=None):
+    """Evaluates a stack of allocations of the same agents (e.g. all the allocation rounds of a simulation round) in one vectorized pass.
+    The rows can also be agent classes (agents with identical preferences), with weights the nr of agents in each class and the fraction of the class in each facility as allocation.
 
-        return alloc_pos.mean(), alloc_pos_by_group
+    Args:
+        allocations (np.array): array of shape (nr_rounds, total_pop, 1) where each agent is allocated to 1 facility in each round, or a stack of fractional allocations of shape (nr_rounds, total_pop, nr_facilities) (see is_fractional).
+        pref_list (np.array): preference list - shape = (total_pop, nr_preferences). For truncated lists, an allocation outside of the list counts as position nr_preferences.
+        travel_time (np.array): travel time from each agent to each facility - shape = (total_pop, nr_facilities)
+        group_codes (np.array): group id (0, ..., nr_groups - 1) of each agent - shape = (total_pop, )
+        capacities (np.array): capacity of each facility - shape = (nr_facilities, )
+        nr_groups (int): total nr of groups.
+        utility (np.array, optional): utility of each facility for each agent - shape = (total_pop, nr_facilities). Defaults to None.
+        weights (np.array, optional): nr of agents each row stands for - shape = (total_pop, ). Defaults to None (one agent per row).
+        pref_ranks (np.array, optional): rank matrix of pref_list (see preference.preference_ranks), computed if not given. Defaults to None.
+
+    Returns:
+        dict: evaluation metrics (same as Runner.evaluate, without facility_rank_distr), each with a leading nr_rounds axis, and the utility of each agent (if utility is given, nan for unassigned agents).
+            Travel time, preference position and utility are averaged over the assigned agents only, unassigned_share is the share of the agents that did not get a facility.
+    """
+    nr_rounds, nr_agents = allocations.shape[:2]
+    nr_facilities = len(capacities)
+    if weights is None:
+        weights = np.ones(nr_agents)
+    # One-hot (weighted) group membership, shape = (total_pop, nr_groups).
+    group_weights = np.eye(nr_groups)[group_codes] * weights[:, np.newaxis]
+
+    # Position of every facility in the list of each agent (nr_preferences for facilities that are not listed).
+    if pref_ranks is None:
+        pref_ranks = preference_ranks(pref_list, nr_facilities)
+
+    if is_fractional(allocations):
+        # Expected nr of agents of each group in each facility, shape = (nr_rounds, nr_facilities, nr_groups).
+        grp_composition = np.matmul(group_weights.T, allocations).transpose(0, 2, 1)
     else:
-        return alloc_pos.mean()
\ No newline at end of file
+        # Count all (round, facility, group) triples in one pass. Unassigned agents (-1) are not counted.
+        r, n = np.nonzero(allocations[..., 0] >= 0)
+        codes = (r * nr_facilities + allocations[r, n, 0].astype(np.int64)) * nr_groups + group_codes[n]
+        grp_composition = np.bincount(codes, weights=weights[n], minlength=nr_rounds * nr_facilities * nr_groups).reshape(nr_rounds, nr_facilities, nr_groups)
+    # Values of the allocated facility of each agent in each round, shape = (nr_rounds, total_pop) - unassigned agents are left out of the means (see _allocated_values).
+    tt_to_alloc, assigned = _allocated_values(travel_time, allocations)
+    alloc_pos, _ = _allocated_values(pref_ranks, allocations)
+    assigned_agents = assigned @ weights
+    assigned_by_group = assigned @ group_weights
+
+    alloc_by_facility = grp_composition.sum(axis=2)
+    # In this particular division, we don't want to get a warning for division by 0, it just means that the facility is empty and nan is fine.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        grp_composition_pct = grp_composition / alloc_by_facility[..., np.newaxis]
+        # Means over the assigned agents, nan if there are none (e.g. in a group).
+        mean_tt_to_alloc = tt_to_alloc @ weights / assigned_agents
+        mean_tt_to_alloc_by_group = tt_to_alloc @ group_weights / assigned_by_group
+        pref_of_alloc = alloc_pos @ weights / assigned_agents
+        pref_of_alloc_by_group = alloc_pos @ group_weights / assigned_by_group
+    # Dissimilarity index (2 groups), see dissimilarity_index.
+    A = grp_composition[..., 0].sum(axis=1, keepdims=True)
+    B = grp_composition[..., 1].sum(axis=1, keepdims=True)
+    di = 1/2 * np.abs(grp_composition[..., 0]/A - grp_composition[..., 1]/B).sum(axis=1)
+    # Average position (starting at 1) of each facility in the preference lists, the same for all rounds (see facility_rank_distribution).
+    listed = pref_ranks < pref_list.shape[1]
+    avg_pos_by_fac = np.where(listed, pref_ranks + 1, 0).T @ weights / weights.sum()
+
+    eval_metrics = {
+        'alloc_by_facility': alloc_by_facility,
+        'avg_pos_by_fac': np.tile(avg_pos_by_fac, (nr_rounds, 1)),
+        'capacity': alloc_by_facility / capacities,
+        'grp_composition': grp_composition,
+        'grp_composition_pct': grp_composition_pct,
+        'dissimilarity_index': di,
+        'mean_tt_to_alloc': mean_tt_to_alloc,
+        'mean_tt_to_alloc_by_group': mean_tt_to_alloc_by_group,
+        'pref_of_alloc': pref_of_alloc,
+        'pref_of_alloc_by_group': pref_of_alloc_by_group,
+        'unassigned_share': 1 - assigned_agents / weights.sum(),
+    }
+    if utility is not None:
+        alloc_utility, _ = _allocated_values(utility, allocations)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            eval_metrics['utility'] = np.where(assigned > 0, alloc_utility / assigned, np.nan)
+
+    return eval_metrics
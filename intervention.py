@@ -1,71 +1,360 @@
+import copy
+import heapq
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 from network import Network
 
-def get_candidate_edges(network: Network, node_id: int):
+def get_candidate_edges(network: Network, node_id: int, k_nearest=None, max_length=None):
     """Returns a list of candidate edges to add to the network, that are not already conncted to the given node.
+    On networks with x/y node coordinates, the candidates can be restricted to the spatially closest nodes (see Network.spatial_neighbors).
 
     Args:
         network (Network): the network.
         node_id (int): the node to connect to.
+        k_nearest (int, optional): if given, only the k nearest nodes (by coordinates) are candidates. Defaults to None.
+        max_length (float, optional): if given, only nodes within this distance (in the units of the coordinates) are candidates. Defaults to None.
 
     Returns:
         list: list of candidate edges to add to the network, that are not already conncted to the given node.
     """    
-    # Get the indices of the non-connected nodes in the adjacecy matrix.
-    candidate_nodes = np.where(network.get_adj_matrix()[node_id] == 0)
+    excluded = network.network.neighbors(node_id, mode='out') + [node_id]
+    if k_nearest is not None or max_length is not None:
+        # Spatial neighbours that are not connected yet - scales with the nr of spatial neighbours and the degree of the node, not with the network size.
+        excluded = set(excluded)
+        candidates = [cn for cn in np.sort(network.spatial_neighbors(node_id, k=k_nearest, max_distance=max_length)) if cn not in excluded]
+    else:
+        is_candidate = np.ones(len(network.network.vs), dtype=bool)
+        is_candidate[excluded] = False
+        candidates = np.flatnonzero(is_candidate)
 
-    candidate_edges = [(node_id, cn) for cn in candidate_nodes[0] if cn != node_id]
+    candidate_edges = [(node_id, cn) for cn in candidates]
 
     if len(candidate_edges) == 0:
-        print('Cannot add more edges, all nodes are connected to the given node.')
+        # With a spatial filter, an empty set is common (e.g. for every facility in a dense area), so it's not reported.
+        if k_nearest is None and max_length is None:
+            print('Cannot add more edges, all nodes are connected to the given node.')
         return None
     
     return candidate_edges
     
 
-def create_random_edge(network: Network, edge_weight=1):
+def create_random_edge(network: Network, edge_weight=1, max_tries=1000, rng=None):
     """Creates a random edge between two nodes that are not connected.
+    Node pairs are drawn uniformly and rejected if they are the same node or already connected.
 
     Args:
         network (Network): the network.
         edge_weight (int, optional): weight of the edge to add. Defaults to 1.
+        max_tries (int, optional): nr of rejected pairs after which the pair is drawn from the non-neighbours of a node directly (for very dense networks). Defaults to 1000.
+        rng (np.random.Generator, optional): random generator to draw the nodes with. Defaults to None (numpy's global random state).
 
     Returns:
         tuple: (x, y, edge_weight) where x and y are the indices of the nodes to connect and edge_weight is the weight of the edge.
     """
-    # Get the current adjacency matrix of the network.
-    adj_mx = network.get_adj_matrix()
-    # Get the indices of the non-connected nodes in the adjacecy matrix.
-    candidate_idx = np.where(adj_mx == 0)
-    if len(candidate_idx[0]) <= 0:
+    n = len(network.network.vs)
+    # Nr of non-(out-)neighbours of each node (neighborhood does not count multi-edges and self loops).
+    non_neighbors = n - 1 - np.array([len(nb) for nb in network.network.neighborhood(mode='out', mindist=1)])
+    if non_neighbors.sum() <= 0:
         return None, None, None
-    # assert len(candidate_idx[0]) > 0, 'Cannot add more edges, all nodes are connected.'
-    # Get a random index from the non-connected nodes.
-    rand_idx = np.random.choice(candidate_idx[0].shape[0])
-    x = candidate_idx[0][rand_idx]
-    y = candidate_idx[1][rand_idx]
 
-    assert adj_mx[x][y] == 0, 'Selected nodes are already connected via an edge.'
+    for _ in range(max_tries):
+        x, y = rng.integers(n, size=2) if rng is not None else np.random.randint(n, size=2)
+        if x != y and network.network.get_eid(x, y, error=False) == -1:
+            return x, y, edge_weight
+
+    # Same distribution as the rejection sampling: pick x proportionally to its nr of non-neighbours, then one of them uniformly.
+    choice = rng.choice if rng is not None else np.random.choice
+    x = choice(n, p=non_neighbors / non_neighbors.sum())
+    candidate_edges = get_candidate_edges(network, x)
+    y = candidate_edges[choice(len(candidate_edges))][1]
+
     return x, y, edge_weight
 
-def maximize_node_centrality(network: Network, node_id: int, centrality_measure: str, group_weights=None, edge_weight=1):
+def score_candidate_edges(network: Network, node_id: int, candidate_edges: list, centrality_measure: str, group_weights=None, edge_weight=1):
+    """Scores all candidate edges of a node at once for closeness-type centrality measures, without adding them to the network.
+    After adding the edge (node_id, c), the new distances from node_id follow from the current ones: d'(node_id, j) = min(d(node_id, j), edge_weight + d(c, j)).
+    Distances are based on the network's travel times (edge weights), which is the same as igraph's (hop-based) closeness on unweighted networks.
+
+    Args:
+        network (Network): the network.
+        node_id (int): the node we want to maximize the centrality of.
+        candidate_edges (list): list of candidate edges (node_id, c), as returned by get_candidate_edges.
+        centrality_measure (str): the centrality measure to score. Accepted values: ['closeness', 'group_closeness'].
+        group_weights (np.array, optional): weights of each node (shape = (nr_nodes,)) or of each node for each group (shape = (nr_groups, nr_nodes)). Required for group_closeness.
+        edge_weight (int, optional): weight of the edge to add. Defaults to 1.
+
+    Returns:
+        np.array: centrality of node_id after adding each candidate edge - shape = (len(candidate_edges),), or (len(candidate_edges), nr_groups) for 2-D group_weights.
+    """
+    assert centrality_measure in ['closeness', 'group_closeness'], 'Only closeness and group_closeness candidate edges can be scored analytically.'
+    if centrality_measure == 'group_closeness' and group_weights is None:
+        raise ValueError('Group weights must be provided to calculate group closeness.')
+
+    candidate_nodes = [edge[1] for edge in candidate_edges]
+    # Distances from node_id and from each candidate node to all nodes (the network is undirected), taken from the travel time matrix when available.
+    distances = network.distances_to([node_id] + candidate_nodes).T
+    new_distances = np.minimum(distances[[0]], edge_weight + distances[1:])
+
+    return _closeness_from_distances(new_distances, centrality_measure, group_weights)
+
+def _closeness_from_distances(distances, centrality_measure: str, group_weights=None):
+    """Internal helper function that calculates closeness-type centralities from rows of distances.
+
+    Args:
+        distances (np.array): 2-D array where each row holds the distances from a node to all nodes.
+        centrality_measure (str): 'closeness' (same as igraph's normalized closeness) or 'group_closeness' (same as Network.weighted_closeness).
+        group_weights (np.array, optional): weights of each node (shape = (nr_nodes,)) or of each node for each group (shape = (nr_groups, nr_nodes)). Required for group_closeness.
+
+    Returns:
+        np.array: centrality of each row - shape = (nr_rows,), or (nr_rows, nr_groups) for 2-D group_weights.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if centrality_measure == 'closeness':
+            # Only reachable nodes are considered.
+            reachable = np.isfinite(distances)
+            scores = (reachable.sum(axis=1) - 1) / np.where(reachable, distances, 0).sum(axis=1)
+        elif centrality_measure == 'group_closeness':
+            scores = 1 / (distances @ np.asarray(group_weights, dtype=float).T)
+
+    # Unreachable or zero-weight nodes lead to inf/nan centrality, which never counts as an improvement.
+    scores[~np.isfinite(scores)] = 0
+    return scores
+
+def rank_facility_edges(network: Network, facility_nodes: list, centrality_measure: str, group_weights=None, edge_weight=1, top_k=10, candidate_filter=None):
+    """Searches the candidate edges of all facility nodes (and all groups, for group_closeness) for the ones that increase the centrality of their facility the most.
+    Facilities are visited in order of an upper bound of their possible gain, and the search stops as soon as no remaining facility can beat the k-th best edge found.
+    The bound uses that any node j != f is at least min(d(f, j), edge_weight) away from f after adding an edge to f.
+
+    Args:
+        network (Network): the network.
+        facility_nodes (list): the facility nodes to search candidate edges for.
+        centrality_measure (str): the centrality measure to maximize for. Accepted values: ['closeness', 'group_closeness'].
+        group_weights (np.array, optional): weights of each node for each group - shape = (nr_groups, nr_nodes). Required for group_closeness.
+        edge_weight (int, optional): weight of the edge to add. Defaults to 1.
+        top_k (int, optional): number of best edges to return. Defaults to 10.
+        candidate_filter (dict, optional): spatial filter of the candidate edges, passed to get_candidate_edges (k_nearest, max_length). Defaults to None.
+
+    Returns:
+        list: up to top_k tuples (gain, x, y, group_id), sorted by gain (descending), where gain is the centrality increase of facility x when adding the edge (x, y). group_id is None for closeness.
+    """
+    assert centrality_measure in ['closeness', 'group_closeness'], 'Only closeness and group_closeness edges can be ranked over all facilities.'
+    if centrality_measure == 'group_closeness' and group_weights is None:
+        raise ValueError('Group weights must be provided to calculate group closeness.')
+
+    facility_nodes = np.unique(facility_nodes)
+    n = len(network.network.vs)
+    # shape = (nr_facilities, nr_nodes), the network is undirected.
+    distances = network.distances_to(facility_nodes).T
+    current = _closeness_from_distances(distances, centrality_measure, group_weights).reshape(len(facility_nodes), -1)
+
+    # Upper bound of the centrality of each facility after adding any edge to it.
+    lower_bound_distances = np.minimum(distances, edge_weight)
+    lower_bound_distances[np.arange(len(facility_nodes)), facility_nodes] = 0
+    upper_bound = _closeness_from_distances(lower_bound_distances, centrality_measure, group_weights).reshape(len(facility_nodes), -1)
+    if centrality_measure == 'closeness':
+        # If not all nodes are reachable, the number of reachable nodes can also grow, so fall back to a looser bound.
+        disconnected = ~np.isfinite(distances).all(axis=1)
+        with np.errstate(divide='ignore'):
+            upper_bound[disconnected, 0] = 1 / np.where(lower_bound_distances > 0, lower_bound_distances, np.inf)[disconnected].min(axis=1)
+    max_gain = (upper_bound - current).max(axis=1)
+
+    # Bounded min-heap of the best edges: (gain, -order, x, y, group_id). On equal gains, the edge that comes first (by facility, candidate node, group) wins.
+    top_edges = []
+    for fid in np.argsort(-max_gain, kind='stable'):
+        if len(top_edges) == top_k and max_gain[fid] < top_edges[0][0]:
+            break
+
+        node_id = facility_nodes[fid].item()
+        candidate_edges = get_candidate_edges(network, node_id, **(candidate_filter or {}))
+        if candidate_edges is None:
+            continue
+
+        gains = score_candidate_edges(network, node_id, candidate_edges, centrality_measure, group_weights=group_weights, edge_weight=edge_weight).reshape(len(candidate_edges), -1) - current[fid]
+        order = ((fid * n + np.array([edge[1] for edge in candidate_edges]))[:, np.newaxis] * gains.shape[1] + np.arange(gains.shape[1])).ravel()
+        gains = gains.ravel()
+        # Only the best top_k edges of this facility can make it to the heap.
+        for i in np.argsort(-gains, kind='stable')[:top_k]:
+            edge = candidate_edges[i // current.shape[1]]
+            entry = (gains[i].item(), -order[i].item(), edge[0], edge[1], None if centrality_measure == 'closeness' else (i % current.shape[1]).item())
+            if len(top_edges) < top_k:
+                heapq.heappush(top_edges, entry)
+            elif entry > top_edges[0]:
+                heapq.heapreplace(top_edges, entry)
+
+    return [(gain, x, y, group_id) for gain, _, x, y, group_id in sorted(top_edges, reverse=True)]
+
+def _facility_objective(facility_distances, centrality_measure: str, group_weights=None):
+    """Internal helper function that calculates the total (group) closeness of the facilities, for one or more versions of their distances.
+
+    Args:
+        facility_distances (np.array): distances from each facility to all nodes - shape = (nr_facilities, nr_nodes) or (nr_versions, nr_facilities, nr_nodes).
+        centrality_measure (str): 'closeness' or 'group_closeness'.
+        group_weights (np.array, optional): weights of each node for each group - shape = (nr_groups, nr_nodes). Required for group_closeness.
+
+    Returns:
+        np.array: sum of the centrality of all facilities (and groups) - one value per version.
+    """
+    rows = facility_distances.reshape(-1, facility_distances.shape[-1])
+    centrality = _closeness_from_distances(rows, centrality_measure, group_weights)
+    return centrality.reshape(facility_distances.shape[:-1] + (-1,)).sum(axis=(-2, -1))
+
+def _edge_gains(network: Network, facility_distances, from_v: int, to_nodes: list, centrality_measure: str, group_weights=None, edge_weight=1):
+    """Internal helper function that calculates the marginal gain of the total facility (group) closeness for the candidate edges (from_v, v), for every v in to_nodes.
+    The distances after adding (u, v) follow from the current ones: d'(f, j) = min(d(f, j), d(f, u) + w + d(v, j), d(f, v) + w + d(u, j)).
+
+    Returns:
+        np.array: the marginal gain of each candidate edge.
+    """
+    objective = _facility_objective(facility_distances, centrality_measure, group_weights)
+    rows = network.distances_to([from_v] + list(to_nodes)).T
+    gains = np.empty(len(to_nodes))
+    # Chunk the candidates, so that the (candidates, facilities, nodes) array stays small.
+    chunk_size = max(1, 2 ** 22 // facility_distances.size)
+    for start in range(0, len(to_nodes), chunk_size):
+        v = np.asarray(to_nodes[start:start + chunk_size])
+        new_distances = np.minimum(facility_distances[np.newaxis], facility_distances[:, [from_v]][np.newaxis] + edge_weight + rows[1 + start:1 + start + len(v), np.newaxis, :])
+        np.minimum(new_distances, facility_distances[:, v].T[:, :, np.newaxis] + edge_weight + rows[0][np.newaxis, np.newaxis, :], out=new_distances)
+        gains[start:start + len(v)] = _facility_objective(new_distances, centrality_measure, group_weights) - objective
+
+    return gains
+
+def plan_facility_edges(network: Network, facility_nodes: list, centrality_measure: str, budget: int, group_weights=None, edge_weight=1, candidate_filter=None):
+    """Plans and adds budget new edges to the network that maximize the total (group) closeness of the facilities, with a greedy search.
+    After each pick, all remaining candidate edges (incident to a facility) are re-scored on the updated network, and the edge with the largest gain is added.
+    Closeness is not submodular (an edge can make another edge more useful), so stale gains are no upper bound and a lazy (CELF) search could miss the greedy pick.
+    The speedup comes from _edge_gains instead, which scores all candidates of a facility from a few distance rows, without copying the network.
+
+    Args:
+        network (Network): the network - the planned edges are added to it with Network.add_edge.
+        facility_nodes (list): the facility nodes.
+        centrality_measure (str): the centrality measure to maximize for. Accepted values: ['closeness', 'group_closeness'].
+        budget (int): nr of edges to add.
+        group_weights (np.array, optional): weights of each node for each group - shape = (nr_groups, nr_nodes). Required for group_closeness.
+        edge_weight (int, optional): weight of the edges to add. Defaults to 1.
+        candidate_filter (dict, optional): spatial filter of the candidate edges, passed to get_candidate_edges (k_nearest, max_length). Defaults to None.
+
+    Returns:
+        list: the added edges (igraph.Edge).
+    """
+    assert centrality_measure in ['closeness', 'group_closeness'], 'Only closeness and group_closeness edges can be planned with the greedy search.'
+    if centrality_measure == 'group_closeness' and group_weights is None:
+        raise ValueError('Group weights must be provided to calculate group closeness.')
+
+    facility_nodes = np.unique(facility_nodes)
+
+    # Candidate edges per facility, (u, [v, ...]). Edges between two facilities are only considered once.
+    candidates = []
+    for u in facility_nodes.tolist():
+        candidate_edges = get_candidate_edges(network, u, **(candidate_filter or {}))
+        if candidate_edges is None:
+            continue
+        candidates.append((u, [v for _, v in candidate_edges if not (v in facility_nodes and v < u)]))
+
+    added_edges = []
+    for _ in range(budget):
+        facility_distances = network.distances_to(facility_nodes).T
+        # On equal gains, the edge that comes first wins.
+        best_gain, best_edge = None, None
+        for u, to_nodes in candidates:
+            if len(to_nodes) == 0:
+                continue
+            gains = _edge_gains(network, facility_distances, u, to_nodes, centrality_measure, group_weights, edge_weight)
+            i = int(np.argmax(gains))
+            if best_gain is None or gains[i] > best_gain:
+                best_gain, best_edge = gains[i], (u, to_nodes[i])
+
+        if best_gain is None or best_gain <= 0:
+            print(f'Warning - No edge could be added that improves the facility {centrality_measure}.')
+            break
+
+        u, v = best_edge
+        added_edges.append(network.add_edge(u, v, edge_weight))
+        candidates = [(c, [w for w in to_nodes if (c, w) != best_edge]) for c, to_nodes in candidates]
+
+    return added_edges
+
+def _candidate_centrality(network: Network, node_id: int, edge: tuple, centrality_measure: str, group_weights=None, edge_weight=1):
+    """Internal helper function that adds the candidate edge to the network, calculates the centrality of the given node and removes the edge again.
+
+    Args:
+        network (Network): the network.
+        node_id (int): the node we want to maximize the centrality of.
+        edge (tuple): the candidate edge (node_id, c).
+        centrality_measure (str): the centrality measure to calculate (see maximize_node_centrality).
+        group_weights (np.array, optional): weights of each node, required for the group_* measures. Defaults to None.
+        edge_weight (int, optional): weight of the edge to add. Defaults to 1.
+
+    Returns:
+        float: the centrality of the given node with the candidate edge added to the network.
+    """
+    # Add the edge to the graph
+    network.network.add_edge(edge[0], edge[1], weight=edge_weight)
+
+    # Calculate the centrality of the input node
+    if centrality_measure == 'closeness':
+        centrality = network.network.closeness(node_id)
+    elif centrality_measure == 'betweenness':
+        centrality = network.network.betweenness(node_id)
+    elif centrality_measure == 'degree':
+        centrality = network.network.degree(node_id)
+    elif centrality_measure == 'group_closeness':
+        if group_weights is None:
+            raise ValueError('Group weights must be provided to calculate group closeness.')
+
+        centrality = network.weighted_closeness(node_id, weights=group_weights)
+    elif centrality_measure == 'group_betweenness':
+        if group_weights is None:
+            raise ValueError('Group weights must be provided to calculate group betweenness.')
+
+        centrality = network.weighted_betweeness(node_id, weights=group_weights)
+    elif centrality_measure == 'group_degree':
+        if group_weights is None:
+            raise ValueError('Group weights must be provided to calculate group degree.')
+
+        centrality = network.weighted_degree(node_id, weights=group_weights)
+
+    # Remove the edge from the graph
+    network.network.delete_edges(edge)
+
+    return centrality
+
+# Per-process state of the candidate evaluation pool, set once per worker by _init_candidate_worker.
+_worker_args = None
+
+def _init_candidate_worker(network: Network, node_id: int, centrality_measure: str, group_weights, edge_weight):
+    """Internal helper function that initializes a worker of the candidate evaluation pool with its own copy of the network."""
+    global _worker_args
+    _worker_args = (network, node_id, centrality_measure, group_weights, edge_weight)
+
+def _score_candidate_shard(edges: list):
+    """Internal helper function that scores a shard of candidate edges in a worker of the candidate evaluation pool.
+
+    Returns:
+        list: (edge, centrality) pairs, in the same order as edges.
+    """
+    network, node_id, centrality_measure, group_weights, edge_weight = _worker_args
+    return [(edge, _candidate_centrality(network, node_id, edge, centrality_measure, group_weights, edge_weight)) for edge in edges]
+
+def maximize_node_centrality(network: Network, node_id: int, centrality_measure: str, group_weights=None, edge_weight=1, n_jobs=1, candidate_filter=None):
     """Returns the edge that maximizes the given centrality measure of the given node.
+    Closeness-type measures score all candidate edges at once from the travel time matrix (see score_candidate_edges).
+    The other measures add every candidate edge to the graph and recalculate the centrality: for (group_)betweenness this is a full Brandes pass over the network per candidate,
+    so the cost grows with nr of candidates x nr of nodes x nr of edges. n_jobs spreads the candidates over processes, candidate_filter reduces their number.
 
     Args:
         network (Network): the network.
         node_id (int): the node we want to maximize the centrality of.
         centrality_measure (str): the centrality measure to maximize for. Accepted values: ['closeness', 'betweenness', 'degree', 'group_closeness', 'group_betweenness', 'group_degree'].
         edge_weight (int, optional): weight of the edge to add. Defaults to 1.
+        n_jobs (int, optional): number of worker processes to score the candidate edges with, for measures that are not scored analytically. Defaults to 1 (serial).
+        candidate_filter (dict, optional): spatial filter of the candidate edges, passed to get_candidate_edges (k_nearest, max_length). Defaults to None.
 
     Returns:
         tuple: (x, y, edge_weight) where x and y are the indices of the nodes to connect and edge_weight is the weight of the edge that maximizes the centrality of the given node.
     """
     assert centrality_measure in ['closeness', 'betweenness', 'degree', 'group_closeness', 'group_betweenness', 'group_degree'], 'Invalid centrality measure.'
 
-    # Get the node object from the node ID
-    node = network.network.vs.find(node_id)
-
-    candidate_edges = get_candidate_edges(network, node_id)
+    candidate_edges = get_candidate_edges(network, node_id, **(candidate_filter or {}))
 
     if candidate_edges is None:
         return None, None, None
@@ -75,43 +364,34 @@ def maximize_node_centrality(network: Network, node_id: int, centrality_measure:
     # Initialize a variable to store the edge with the maximum centrality
     max_edge = None
 
-    # Loop through all the possible edges
-    for edge in candidate_edges:
-        # Add the edge to the graph
-        network.network.add_edge(edge[0], edge[1], weight=edge_weight)
+    # Closeness-type measures: score all candidates at once from the travel time matrix, without changing the network.
+    if centrality_measure in ['closeness', 'group_closeness']:
+        scores = score_candidate_edges(network, node_id, candidate_edges, centrality_measure, group_weights=group_weights, edge_weight=edge_weight)
+        # argmax returns the first maximum, same as the loop below (which only updates on strictly greater centrality).
+        if scores.max() > max_centrality:
+            max_edge = candidate_edges[scores.argmax()]
+        candidate_edges = []
 
-        # Calculate the centrality of the input node
-        if centrality_measure == 'closeness':
-            centrality = network.network.closeness(node)
-        elif centrality_measure == 'betweenness':
-            centrality = network.network.betweenness(node)
-        elif centrality_measure == 'degree':
-            centrality = network.network.degree(node)
-        elif centrality_measure == 'group_closeness':
-            if group_weights is None:
-                raise ValueError('Group weights must be provided to calculate group closeness.')
-
-            centrality = network.weighted_closeness(node_id, weights=group_weights)
-        elif centrality_measure == 'group_betweenness':
-            if group_weights is None:
-                raise ValueError('Group weights must be provided to calculate group betweenness.')
-
-            centrality = network.weighted_betweeness(node_id, weights=group_weights)
-        elif centrality_measure == 'group_degree':
-            if group_weights is None:
-                raise ValueError('Group weights must be provided to calculate group degree.')
-
-            centrality = network.weighted_degree(node_id, weights=group_weights)
+    if n_jobs > 1 and len(candidate_edges) > 1:
+        # Shard the candidates over a process pool - every worker gets its own copy of the graph once (the travel time matrix is not needed).
+        worker_network = copy.copy(network)
+        worker_network.tt_mx = None
+        shard_size = int(np.ceil(len(candidate_edges) / (n_jobs * 4)))
+        shards = [candidate_edges[i:i + shard_size] for i in range(0, len(candidate_edges), shard_size)]
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_candidate_worker, initargs=(worker_network, node_id, centrality_measure, group_weights, edge_weight)) as executor:
+            # map keeps the order of the shards, so the scored edges are in the same order as in the serial loop.
+            scored_edges = [scored for shard in executor.map(_score_candidate_shard, shards) for scored in shard]
+    else:
+        scored_edges = ((edge, _candidate_centrality(network, node_id, edge, centrality_measure, group_weights, edge_weight)) for edge in candidate_edges)
 
+    # Loop through all the possible edges
+    for edge, centrality in scored_edges:
         # If the centrality is greater than the current maximum,
         # update the maximum and the edge with the maximum centrality
         if centrality > max_centrality:
             max_centrality = centrality
             max_edge = edge
 
-        # Remove the edge from the graph
-        network.network.delete_edges(edge)
-
     if max_edge is None:
         print(f'Warning - No edge could be added for node {node_id} and centrality measure {centrality_measure}. Probably ll edges lead to 0 centrality.')
         return None, None, None
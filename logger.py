@@ -53,7 +53,8 @@ class Logger(object):
         if round is not None:
             path = self.rounds_path / str(round) / filename
 
-        np.savetxt(path, array, delimiter=',')
+        # Integer arrays (e.g. preference lists or allocations) are saved as integers.
+        np.savetxt(path, array, delimiter=',', fmt='%d' if np.issubdtype(array.dtype, np.integer) else '%.18e')
 
     def save_plot(self, fig, filename, round=None, subdir=None):
         """Saves the given figure to the results folder.
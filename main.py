@@ -40,12 +40,13 @@ if __name__ == "__main__":
         print(f'Running {args.config} configuration - no results saved')
         
 
-    # TODO: probably want to move calc_tt_mx flag to config file (maybe want to set to False for large networks.)
-    network = Network(config['network_file'], calc_tt_mx=True)
     population = pd.read_csv(config['population_file'])
     facilities = pd.read_csv(config['facilities_file'])
+    # For large networks, only store the travel times from all nodes to the facility nodes.
+    tt_targets = facilities['node'].values if config.get('travel_time_matrix', 'full') == 'facilities' else None
+    network = Network(config['network_file'], calc_tt_mx=True, tt_targets=tt_targets, tt_cache=config.get('travel_time_cache', False))
 
-    runner = Runner(network, population, facilities, logger)
+    runner = Runner(network, population, facilities, logger, seed=config.get('seed', None))
 
     runner.run_simulation(
             config['simulation_rounds'],
@@ -56,7 +57,9 @@ if __name__ == "__main__":
             config['allocation_model'], 
             config['intervention_model'], 
             preference_model_params=config.get('preference_model_params', None),
-            update_preference_params=config['update_preference_params'])
+            update_preference_params=config['update_preference_params'],
+            intervention_model_params=config.get('intervention_model_params', None),
+            allocation_model_params=config.get('allocation_model_params', None))
     
     sim_time = time.time() - sim_start
     print(f"All is said and done in {sim_time} seconds, which is {sim_time / 60} minutes.")
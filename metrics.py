@@ -0,0 +1,113 @@
+import numpy as np
+
+class RunningStats(object):
+    """Running mean and variance of a stream of samples (Welford's algorithm, merged per batch with Chan's formula), in constant memory.
+    Samples can be arrays of any (fixed) shape, the statistics are element-wise.
+    """
+    def __init__(self, shape=()):
+        self.count = 0
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+
+    def update(self, samples):
+        """Adds a batch of samples to the statistics.
+
+        Args:
+            samples (np.array): array of shape (nr_samples, *shape).
+        """
+        samples = np.asarray(samples, dtype=float)
+        n = samples.shape[0]
+        if n == 0:
+            return
+        batch_mean = samples.mean(axis=0)
+        batch_m2 = ((samples - batch_mean) ** 2).sum(axis=0)
+        total = self.count + n
+        delta = batch_mean - self.mean
+        self.mean = self.mean + delta * n / total
+        self.m2 = self.m2 + batch_m2 + delta ** 2 * self.count * n / total
+        self.count = total
+
+    @property
+    def variance(self):
+        """Population variance (ddof=0) of the samples so far."""
+        return self.m2 / self.count
+
+    def ci(self, z=1.96):
+        """Returns the mean and confidence interval of the samples so far, same as evaluation.calculate_ci on all the samples.
+
+        Args:
+            z (float, optional): the z value for the confidence interval. Defaults to 1.96.
+
+        Returns:
+            np.array: array of shape (3, *shape) - mean, lower and upper bound.
+        """
+        se = np.sqrt(self.variance) / np.sqrt(self.count)
+        return np.stack([self.mean, self.mean - z * se, self.mean + z * se])
+
+class MetricSeries(object):
+    """Running statistics of a metric for every simulation round, over the allocation rounds of that round.
+    Replaces a dense (simulation_rounds, allocation_rounds, *shape) array of the metric - only the mean and variance of each simulation round are kept.
+    """
+    def __init__(self, simulation_rounds, shape=()):
+        self.rounds = [RunningStats(shape) for _ in range(simulation_rounds)]
+
+    def update(self, round, samples):
+        """Adds the metric of a batch of allocation rounds of simulation round round, shape = (nr_allocation_rounds, *shape)."""
+        self.rounds[round].update(samples)
+
+    def mean(self):
+        """Returns the mean of every simulation round, shape = (simulation_rounds, *shape)."""
+        return np.stack([r.mean for r in self.rounds])
+
+    def ci(self, z=1.96):
+        """Returns the mean and confidence interval of every simulation round, shape = (simulation_rounds, 3, *shape) - same as np.apply_along_axis(calculate_ci, 1, metric)."""
+        return np.stack([r.ci(z) for r in self.rounds])
+
+class RunningHistogram(object):
+    """Histogram of a stream of values over a fixed range, in constant memory. With a fine enough binning, it doubles as a quantile sketch (error of at most one bin width).
+    Values outside of the range are counted in the first/last bin.
+    """
+    def __init__(self, low, high, bins=1000):
+        if high <= low:
+            high = low + 1
+        self.edges = np.linspace(low, high, bins + 1)
+        self.counts = np.zeros(bins)
+
+    def update(self, values, weights=None):
+        """Adds values (any shape) to the histogram, with optional weights of the same shape."""
+        values = np.asarray(values).ravel()
+        bins = np.clip(np.searchsorted(self.edges, values, side='right') - 1, 0, len(self.counts) - 1)
+        self.counts += np.bincount(bins, weights=np.asarray(weights).ravel() if weights is not None else None, minlength=len(self.counts))
+
+    def probabilities(self, bins=None):
+        """Returns the bin edges and the fraction of the values in each bin, optionally merged into fewer bins (bins should divide the nr of bins).
+
+        Args:
+            bins (int, optional): nr of bins to merge the histogram into. Defaults to None (the histogram bins).
+
+        Returns:
+            tuple: (edges, probabilities)
+        """
+        counts, edges = self.counts, self.edges
+        if bins is not None:
+            assert len(counts) % bins == 0, "The nr of bins should divide the nr of histogram bins."
+            counts = counts.reshape(bins, -1).sum(axis=1)
+            edges = edges[::len(self.counts) // bins]
+        return edges, counts / counts.sum()
+
+    def quantile(self, q):
+        """Returns the q-th quantile of the values, linearly interpolated within the bin it falls in.
+
+        Args:
+            q (float): quantile, between 0 and 1.
+
+        Returns:
+            float: the (approximate) quantile.
+        """
+        cumulative = np.cumsum(self.counts)
+        target = q * cumulative[-1]
+        # First bin that reaches the target, skipping empty bins.
+        b = min(np.searchsorted(cumulative, target, side='left'), len(self.counts) - 1)
+        below = cumulative[b] - self.counts[b]
+        within = (target - below) / self.counts[b] if self.counts[b] > 0 else 0
+        return self.edges[b] + within * (self.edges[b + 1] - self.edges[b])
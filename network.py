@@ -1,17 +1,19 @@
+import hashlib
 import igraph as ig
 import numpy as np
-import math
 import os
-from collections import deque
 
 class Network(object):
     DEFAULT_EDGE_COLOR = 'black'
-    def __init__(self, network_path, calc_tt_mx=False):
+    TT_CACHE_DIR = '.tt_cache'
+    def __init__(self, network_path, calc_tt_mx=False, tt_targets=None, tt_cache=False):
         """Holds the transport network.
 
         Args:
             network_path (str): the full path to the network file - used to load the transport network.
             calc_tt_mx (boolean): if set to true, it will pre-calculate and store the travel times from all nodes to all other nodes.
+            tt_targets (list, optional): if given, the travel time matrix only stores the travel times from all nodes to these nodes (e.g. the facility nodes), shape = (nr_nodes, nr_targets). Defaults to None (all nodes).
+            tt_cache (bool, optional): if set to true, the travel time matrix is stored on disk next to the network file (keyed by a fingerprint of the graph) and memory-mapped on the next load of the same graph. Defaults to False.
         """
         _, ext = os.path.splitext(network_path)
         assert ext == ".gml", "only .gml network files are accepted (currently)"
@@ -28,13 +30,111 @@ class Network(object):
         self.network.vs['label'] = [self.network.vs[i].index for i in range(len(self.network.vs))]
         # Keep a list of all the added edges (interventions) to the network.
         self.added_edges = []
+        # Bumped on every change of the network (add_edge), so that computations cached on it can be invalidated.
+        self.version = 0
         # Calculate the travel time matrix from all nodes to all nodes, store it so we don't have to re-calculate it every time.
-        # TODO: think of memory constraints? 
+        # To save memory on large networks, tt_targets restricts the columns of the matrix to the given nodes (O(N*T) instead of O(N^2)).
+        # tt_columns maps a node id to its column in tt_mx (-1 if the node is not a target).
+        self.tt_targets = np.arange(len(self.network.vs)) if tt_targets is None else np.unique(tt_targets)
+        self.tt_columns = np.full(len(self.network.vs), -1)
+        self.tt_columns[self.tt_targets] = np.arange(len(self.tt_targets))
+        self.tt_mx = None
         if calc_tt_mx:
-            self.tt_mx = self.shortest_paths(self.network.vs, self.network.vs)
+            self.tt_mx = self.load_tt_mx() if tt_cache else self.calc_tt_mx()
+        # Spatial index of the node coordinates, built on first use (see spatial_neighbors).
+        self._kd_tree = None
+
+    @property
+    def full_tt_mx(self):
+        """bool: whether the travel time matrix holds the travel times to all nodes (and not only to tt_targets)."""
+        return len(self.tt_targets) == len(self.network.vs)
+
+    def calc_tt_mx(self):
+        """Calculates the travel time matrix from all nodes to the tt_targets nodes.
+
+        Returns:
+            np.array: 2d matrix where element (i,j) is the shortest path (weighted) from node i to target j.
+        """
+        if self.full_tt_mx:
+            return self.shortest_paths(self.network.vs, self.network.vs)
+
+        # Multi-source shortest paths from the targets only, then transpose to get (nodes, targets).
+        return self.distances_to(self.tt_targets)
+
+    def fingerprint(self):
+        """Returns a fingerprint of the graph (nodes, edges and their weights) and the travel time matrix targets. Two graphs with the same fingerprint have the same travel time matrix.
+
+        Returns:
+            str: hex digest of the fingerprint.
+        """
+        weights = self._edge_weights()
+        h = hashlib.sha1()
+        h.update(np.array([len(self.network.vs), self.network.is_directed()], dtype=np.int64).tobytes())
+        h.update(np.array(self.network.get_edgelist(), dtype=np.int64).tobytes())
+        h.update(np.array([1] * len(self.network.es) if weights is None else weights, dtype=np.float64).tobytes())
+        h.update(self.tt_targets.astype(np.int64).tobytes())
+
+        return h.hexdigest()
+
+    def load_tt_mx(self):
+        """Loads the travel time matrix from the on-disk cache, or calculates it and stores it in the cache if it's not there.
+        Cached matrices are memory-mapped copy-on-write, so loading is zero-copy and in-place updates (e.g. add_edge) never modify the cached file.
+
+        Returns:
+            np.array: the travel time matrix (see calc_tt_mx).
+        """
+        cache_dir = os.path.join(os.path.dirname(self.network_path), self.TT_CACHE_DIR)
+        cache_path = os.path.join(cache_dir, f'{os.path.splitext(os.path.basename(self.network_path))[0]}_{self.fingerprint()}.npy')
+        if os.path.exists(cache_path):
+            return np.load(cache_path, mmap_mode='c')
+
+        tt_mx = self.calc_tt_mx()
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to a temporary file first, so parallel runs never read a half-written matrix.
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, tt_mx)
+        os.replace(tmp_path, cache_path)
+
+        return tt_mx
+
+    def distances_to(self, nodes):
+        """Calculates the shortest paths from all nodes to the given nodes. Uses the stored travel time matrix when the nodes are targets of it.
+
+        Args:
+            nodes (list): list of destination nodes (ids).
+
+        Returns:
+            np.array: 2d matrix of shape (nr_nodes, len(nodes)) where element (i,j) is the shortest path (weighted) from node i to nodes[j].
+        """
+        nodes = self._vertex_ids(nodes)
+        if self.tt_mx is not None and np.all(self.tt_columns[nodes] >= 0):
+            return self.tt_mx[:, self.tt_columns[nodes]]
+
+        # One shortest path tree per destination node (on undirected networks the 'in' direction is the same as 'out').
+        tt_mx = np.empty((len(nodes), len(self.network.vs)))
+        tt_mx[:] = self.network.distances(source=nodes, weights=self._edge_weights(), mode='in')
+        return tt_mx.T
+
+    def travel_times(self, orig, dest):
+        """Returns the travel times from the orig nodes to the dest nodes, from the stored travel time matrix.
+
+        Args:
+            orig (list): list of origin nodes (ids) - can contain duplicates (e.g. one entry per agent).
+            dest (list): list of destination nodes (ids) - can contain duplicates (e.g. one entry per facility). Should be part of tt_targets.
+
+        Returns:
+            np.array: 2d matrix where element (i,j) is the travel time from orig[i] to dest[j].
+        """
+        assert self.tt_mx is not None, 'The travel time matrix was not calculated, create the network with calc_tt_mx=True.'
+        dest_columns = self.tt_columns[np.asarray(dest)]
+        assert np.all(dest_columns >= 0), 'Some destination nodes are not part of the travel time matrix targets (tt_targets).'
+
+        return self.tt_mx[np.asarray(orig)][:, dest_columns]
 
     def shortest_paths(self, orig: list, dest: list):
         """Calculates shortest paths from a list of origins to a list of destinations. Both orig and dest should be lists of node ids.
+        All origins are resolved in a single igraph call (one Dijkstra/BFS pass per origin), which fills the whole origin x destination block at once.
 
         Args:
             orig (list): list of origin nodes (ids).
@@ -43,35 +143,119 @@ class Network(object):
         Returns:
             np.array: 2d matrix where element (i,j) is the shortest path (weighted) from i to j and vice versa.
         """
-        # Travel time from all orig nodes to all dest ndoes
-        tt_mx = np.ndarray((len(orig), len(dest)))
-        for i, o in enumerate(orig):
-            for j, d in enumerate(dest):
-                sp = self.network.distances(o, d)[0][0]
-                if sp == math.inf:
-                    print(f'Failed for {o["id"]} - {d["id"]}: No path found between them')
-                    continue
-                tt_mx[i, j] = sp
+        orig = self._vertex_ids(orig)
+        dest = self._vertex_ids(dest)
+
+        # Travel time from all orig nodes to all dest nodes, written into a preallocated array.
+        tt_mx = np.empty((len(orig), len(dest)))
+        tt_mx[:] = self.network.distances(source=orig, target=dest, weights=self._edge_weights())
+
+        unreachable = np.isinf(tt_mx).sum()
+        if unreachable > 0:
+            print(f'Failed for {unreachable} origin-destination pairs: No path found between them')
 
         return tt_mx
 
-    def add_edge(self, from_v, to_v, weight):
-        """Adds a new edge to the transport network. Note: currently does not support weighted edges.
+    def _vertex_ids(self, vertices):
+        """Internal helper function that converts a vertex sequence (or a list of vertices/ids) to a list of vertex ids.
+
+        Args:
+            vertices (igraph.VertexSeq or list): the vertices to convert.
+
+        Returns:
+            list: list of vertex ids.
+        """
+        if isinstance(vertices, ig.VertexSeq):
+            return vertices.indices
+
+        return [v.index if isinstance(v, ig.Vertex) else int(v) for v in vertices]
+
+    def _edge_weights(self):
+        """Internal helper function that returns the edge weights to use for travel times.
+        Edges without a weight (e.g. networks loaded without a weight attribute) count as a single hop.
+
+        Returns:
+            list: weight of each edge, or None if the network has no weighted edges.
+        """
+        if 'weight' not in self.network.es.attribute_names():
+            return None
+
+        return [1 if w is None else w for w in self.network.es['weight']]
+
+    def add_edge(self, from_v, to_v, weight, incremental=True):
+        """Adds a new edge to the transport network and updates the travel time matrix.
 
         Args:
             from_v (int): id of the origin vertex of the new edge.
             to_v (int): id of the destination vertex of the new edge.
+            weight (float): weight (travel time) of the new edge.
+            incremental (bool, optional): if true, the existing travel time matrix is patched in place instead of re-calculating all shortest paths. Defaults to True.
         Returns: 
             igraph.Edge: the newly added edge as an Edge object
 
         """
         edge = self.network.add_edge(from_v, to_v, weight=weight)
         self.added_edges.append(edge)
+        self.version += 1
         # Update the travel time matrix.
-        # Reconsider this if we have a big network.
-        self.tt_mx = self.shortest_paths(self.network.vs, self.network.vs)
+        if incremental and self.tt_mx is not None:
+            self._relax_tt_mx(from_v, to_v, 1 if weight is None else weight)
+        else:
+            self.tt_mx = self.calc_tt_mx()
         return edge
 
+    def _relax_tt_mx(self, from_v, to_v, weight):
+        """Internal helper function that updates the travel time matrix in place after adding the edge (from_v, to_v, weight).
+        A new edge can only shorten paths that go through it, so d(i,j) = min(d(i,j), d(i,u) + w + d(v,j), d(i,v) + w + d(u,j)), with (u, v) = (from_v, to_v).
+        If the matrix only holds the travel times to tt_targets, d(i,u) and d(i,v) are calculated with one shortest path tree each.
+
+        Args:
+            from_v (int): id of the origin vertex of the new edge.
+            to_v (int): id of the destination vertex of the new edge.
+            weight (float): weight (travel time) of the new edge.
+        """
+        u, v = from_v, to_v
+        # Copy the rows/columns first, they are based on the distances before the edge was added and the matrix is updated in place.
+        d_iu, d_iv = self.distances_to([u, v]).T.copy()
+        d_uj = self.tt_mx[u, :] + weight
+        d_vj = self.tt_mx[v, :] + weight
+
+        # Single scratch buffer, so each relaxation step does not allocate a new N x N matrix.
+        through_edge = np.empty_like(self.tt_mx)
+        np.add(d_iu[:, np.newaxis], d_vj[np.newaxis, :], out=through_edge)
+        np.minimum(self.tt_mx, through_edge, out=self.tt_mx)
+        if not self.network.is_directed():
+            np.add(d_iv[:, np.newaxis], d_uj[np.newaxis, :], out=through_edge)
+            np.minimum(self.tt_mx, through_edge, out=self.tt_mx)
+
+    def spatial_neighbors(self, node_id, k=None, max_distance=None):
+        """Returns the nodes closest to the given node as the crow flies, based on the x/y node attributes (e.g. the Amsterdam environments).
+        Backed by a KD-tree of the node coordinates (requires scipy).
+
+        Args:
+            node_id (int): the node to find the spatial neighbours of.
+            k (int, optional): if given, return (at most) the k nearest nodes. Defaults to None.
+            max_distance (float, optional): if given, only return nodes within this distance (in the units of the coordinates). Defaults to None.
+
+        Returns:
+            np.array: ids of the spatial neighbours, excluding the node itself.
+        """
+        assert 'x' in self.network.vs.attribute_names() and 'y' in self.network.vs.attribute_names(), 'Spatial neighbours require x and y node attributes.'
+        if self._kd_tree is None:
+            from scipy.spatial import cKDTree
+            self._kd_tree = cKDTree(np.column_stack([self.network.vs['x'], self.network.vs['y']]))
+
+        point = self._kd_tree.data[node_id]
+        if k is not None:
+            # k + 1 because the node itself is always the nearest one. Missing neighbours (beyond max_distance) get index n.
+            _, neighbors = self._kd_tree.query(point, k=min(k + 1, len(self.network.vs)), distance_upper_bound=np.inf if max_distance is None else max_distance)
+            neighbors = np.atleast_1d(neighbors)
+            neighbors = neighbors[neighbors < len(self.network.vs)]
+        else:
+            neighbors = np.array(self._kd_tree.query_ball_point(point, r=max_distance), dtype=int)
+
+        return neighbors[neighbors != node_id]
+
     def get_adj_matrix(self):
         """Returns the current node adjacency matrix of the network.
 
@@ -141,54 +325,74 @@ class Network(object):
             
         return weighted_closeness
 
-    def weighted_betweeness(self, nodes=None, weights=None):
+    def weighted_betweeness(self, nodes=None, weights=None, batch_size=64):
         """Calculates the weighted betweenness centrality of a given node and given node weights.
 
         Args:
             nodes (int or list): node/s to calculate the weighted betweenness centrality for. If none, it will calculate the centrality for all nodes.
-            weights (list): weights of each node. If none, it will calculate the unweighted centrality of the nodes.
+            weights (list or np.array): weights of each node, or a 2-D array of shape (nr_groups, nr_nodes) with the weights of each node for each group. If none, it will calculate the unweighted centrality of the nodes.
+            batch_size (int, optional): number of sources to traverse at once. Defaults to 64.
 
         Returns:
-            np.float64: the calculated weighted betweenness centrality.
+            np.array: the calculated weighted betweenness centrality - shape = (len(nodes),), or (nr_groups, len(nodes)) if weights is 2-D.
         """
         nodes, weights = self._preprocess_nodes_weights(nodes, weights)
 
-        all_nodes = self.network.vs.indices
-
-        C = np.array([0.0] * len(all_nodes))
-        A = self.network.neighborhood()
-        for s in all_nodes:
-            S = []
-            P = dict((w,[]) for w in all_nodes)
-            g = dict((t, 0) for t in all_nodes); g[s] = 1
-            d = dict((t, -1) for t in all_nodes); d[s] = 0
-            Q = deque([])
-            Q.append(s)
-            while Q:
-                v = Q.popleft()
-                S.append(v)
-                for w in A[v]:
-                    # If d[w] < 0 it means that w has not been visited before
-                    if d[w] < 0:
-                        # Append w to Q (to visit it later)
-                        Q.append(w)
-                        # The distance to w (neighbour of v) is the distance to v plus one.
-                        d[w] = d[v] + 1
-                    # If d[w] == d[v] + 1 it means that v is a predecessor of w
-                    if d[w] == d[v] + 1:
-                        # So update the total number of shortest paths to w (g[w]) by adding the paths that v is a predecessor of
-                        g[w] = g[w] + g[v]
-                        P[w].append(v)
-            e = dict((v, 0) for v in all_nodes)
-            while S:
-                w = S.pop()
-                for v in P[w]:
-                    e[v] = e[v] + (g[v]/g[w]) * (1 + e[w]) * weights[w]
-                    # e[v] = e[v] + (g[v]/g[w]) *  (1 + e[w])
-                if w != s:
-                    C[w] = C[w] + e[w]
-
-        C = C[nodes] / 2
+        # Brandes' algorithm on flat arrays, for a (groups x nodes) weight matrix at once.
+        # Sources are processed in batches: every array below has a flat index of (source in batch) * n + node.
+        weights = np.asarray(weights, dtype=float)
+        single_group = weights.ndim == 1
+        W = np.atleast_2d(weights)
+        n = len(self.network.vs)
+
+        # CSR adjacency (unique neighbours, no self loops), expanded to one (src, dst) entry per arc.
+        A = self.network.neighborhood(mindist=1)
+        indptr = np.cumsum([0] + [len(a) for a in A])
+        dst = np.fromiter((w for a in A for w in a), dtype=np.int64, count=indptr[-1])
+        src = np.repeat(np.arange(n), np.diff(indptr))
+
+        C = np.zeros((W.shape[0], n))
+        for batch_start in range(0, n, batch_size):
+            sources = np.arange(batch_start, min(batch_start + batch_size, n))
+            b = len(sources)
+            # Hop distances from each source (the algorithm counts shortest paths in hops), -1 if not reachable.
+            d = np.array(self.network.distances(source=sources, mode='all'))
+            d = np.where(np.isinf(d), -1, d).astype(np.int64)
+
+            # Predecessor arcs: v is a predecessor of w if d[w] == d[v] + 1, for every source in the batch.
+            is_pred = (d[:, src] >= 0) & (d[:, dst] == d[:, src] + 1)
+            pred_b, pred_arc = np.nonzero(is_pred)
+            pred_level = d[pred_b, dst[pred_arc]]
+            order = np.argsort(pred_level, kind='stable')
+            pred_v = (pred_b * n + src[pred_arc])[order]
+            pred_w = (pred_b * n + dst[pred_arc])[order]
+            pred_w_node = dst[pred_arc][order]
+            level_bounds = np.searchsorted(pred_level[order], np.arange(1, d.max() + 2))
+
+            # Forward pass: number of shortest paths (g) to each node, level by level.
+            g = np.zeros(b * n)
+            g[np.arange(b) * n + sources] = 1
+            for k in range(len(level_bounds) - 1):
+                lvl = slice(level_bounds[k], level_bounds[k + 1])
+                g += np.bincount(pred_w[lvl], weights=g[pred_v[lvl]], minlength=b * n)
+
+            # Backward pass: dependencies (e) of each node, from the furthest level to the sources.
+            e = np.zeros((W.shape[0], b * n))
+            group_offsets = (np.arange(W.shape[0]) * b * n)[:, np.newaxis]
+            for k in reversed(range(len(level_bounds) - 1)):
+                lvl = slice(level_bounds[k], level_bounds[k + 1])
+                v, w = pred_v[lvl], pred_w[lvl]
+                dependency = (g[v] / g[w]) * (1 + e[:, w]) * W[:, pred_w_node[lvl]]
+                e += np.bincount((group_offsets + v).ravel(), weights=dependency.ravel(), minlength=W.shape[0] * b * n).reshape(W.shape[0], b * n)
+
+            # The source itself does not get any credit.
+            e[:, np.arange(b) * n + sources] = 0
+            C += e.reshape(W.shape[0], b, n).sum(axis=1)
+
+        if single_group:
+            C = C[0]
+
+        C = C[..., nodes] / 2
 
         # ----- START Original, very slow code ------
         # all_nodes = self.network.vs
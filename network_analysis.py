@@ -295,7 +295,7 @@ for c_weight in np.arange(0.0, 1, 0.1):
       env = f'{envdir}/SBM_2_50_{p_in}_{p_out}_pop_1500_0.5_[0.8]_{seed}'
       population = pd.read_csv(f'{env}/{population_file}')
       facilities = pd.read_csv(f'{env}/{facilities_file}')
-      network = Network(f'{env}/{network_file}', calc_tt_mx=True)
+      network = Network(f'{env}/{network_file}', calc_tt_mx=True, tt_cache=True)
       runner = Runner(network, population, facilities, logger=None)
       di, rwi = runner.run_simulation(
               simulation_rounds,
@@ -1,4 +1,64 @@
 import numpy as np
+import pandas as pd
+
+def facility_index_dtype(nr_facilities):
+    """Returns the smallest signed integer dtype for facility indices (and -1 for no facility): int16 for less than 32k facilities, int32 otherwise.
+
+    Args:
+        nr_facilities (int): total nr of facilities.
+
+    Returns:
+        np.dtype: the dtype.
+    """
+    return np.dtype(np.int16) if nr_facilities < np.iinfo(np.int16).max else np.dtype(np.int32)
+
+def group_code_dtype(nr_groups):
+    """Returns the dtype for group codes (0, ..., nr_groups - 1): uint8 for less than 256 groups, int32 otherwise.
+
+    Args:
+        nr_groups (int): total nr of groups.
+
+    Returns:
+        np.dtype: the dtype.
+    """
+    return np.dtype(np.uint8) if nr_groups <= np.iinfo(np.uint8).max else np.dtype(np.int32)
+
+def sorted_top_k(scores, k=None):
+    """Returns the indices of the k lowest scores of each row, sorted in ascending order of score.
+    Uses argpartition to select the k lowest scores and only sorts those, instead of sorting the whole row.
+
+    Args:
+        scores (np.array): 2-D array where (i, j) is the score of facility j for agent i (lower is more preferred).
+        k (int, optional): nr of indices to return per row. If None (or not smaller than the nr of columns), the full argsort is returned. Defaults to None.
+
+    Returns:
+        np.array: array of size (nr of agents, k) with the indices of the k lowest scores of each row (compact dtype, see facility_index_dtype).
+    """
+    dtype = facility_index_dtype(scores.shape[1])
+    if k is None or k >= scores.shape[1]:
+        return scores.argsort().astype(dtype)
+
+    top_k = np.argpartition(scores, k - 1, axis=1)[:, :k]
+    order = np.take_along_axis(scores, top_k, axis=1).argsort(axis=1)
+    return np.take_along_axis(top_k, order, axis=1).astype(dtype)
+
+def preference_ranks(pref_list, nr_facilities):
+    """Returns the rank matrix of the preference lists (their inverse permutation): the position of every facility in the list of each agent.
+    Facilities that are not in the (truncated) list, or -1 entries, get rank nr_preferences.
+
+    Args:
+        pref_list (np.array): array of size (nr of agents, nr of preferences) where each facility is sorted by preference.
+        nr_facilities (int): total nr of facilities.
+
+    Returns:
+        np.array: int16 array of size (nr of agents, nr_facilities) where (i, j) is the position of facility j in the preference list of agent i.
+    """
+    assert pref_list.shape[1] < np.iinfo(np.int16).max, "Too many preferences for an int16 rank matrix."
+    rows, cols = np.nonzero(pref_list >= 0)
+    ranks = np.full((pref_list.shape[0], nr_facilities), pref_list.shape[1], dtype=np.int16)
+    ranks[rows, pref_list[rows, cols]] = cols
+
+    return ranks
 
 def nearest_k(tt_mx, k):
     """Returns the nearest k facilities, based on the tt_mx (travel-time matrix.)
@@ -12,16 +72,17 @@ def nearest_k(tt_mx, k):
     """
 
     assert k <= tt_mx.shape[1], f'Cannot pick nearest {k} out of {tt_mx.shape[1]} facilities' 
-    return tt_mx.argsort()[:, :k], tt_mx
+    return sorted_top_k(tt_mx, k), tt_mx
 
 
-def toy_model(tt_mx, qualities):
+def toy_model(tt_mx, qualities, max_pref_length=None):
     """
     Returns an ordered list of k preferred facilities for all agents. 
     In this preference model, the lowest a utility the more it is prefered.
     Args:
         tt_mx (np.array): 2-D array where (i, j) is the travel time for agent i to facility j
         qualities (np.array): array containing facility quality
+        max_pref_length (int, optional): if given, only the top max_pref_length facilities are returned for each agent. Defaults to None (all facilities).
     Returns:
         np.array: indices of nearest k facilities (indices=ids)
     """
@@ -29,15 +90,16 @@ def toy_model(tt_mx, qualities):
     tt_mxn = tt_mx / tt_mx.sum(axis=1)[:, np.newaxis]
     tt_mxn = np.divide(tt_mxn, qualities)
 
-    return tt_mxn.argsort(), tt_mxn
+    return sorted_top_k(tt_mxn, max_pref_length), tt_mxn
 
-def distance_popularity(tt_mx, popularity): 
+def distance_popularity(tt_mx, popularity, max_pref_length=None): 
     """
     Returns an ordered list of k preferred facilities for all agents, based on distance and facility popularity.
     In this preference model, the highest a utility the more it is prefered.
     Args:
         tt_mx (np.array): 2-D array where (i, j) is the travel time for agent i to facility j
         popularity (np.array): array containing facility popularity
+        max_pref_length (int, optional): if given, only the top max_pref_length facilities are returned for each agent. Defaults to None (all facilities).
     Returns:
         np.array: indices of facilities ordered by preference (indices=ids) and the preference matrix (utility of each facility for each agent)
     """
@@ -57,40 +119,154 @@ def distance_popularity(tt_mx, popularity):
 
     # Return the indices of the sorted utilities (descending order) and the utility matrix
     # (-util) is used as a trick to sort in descending order
-    return (-util).argsort(), util
+    return sorted_top_k(-util, max_pref_length), util
 
-def distance_composition(tt_mx, population, facilities, M, C_weight):
+def normalized_distance(tt_mx):
+    """Distance component of the distance_composition preference model: travel times normalized by the maximum and minimum travel time of each agent (1 = closest, 0 = furthest).
+
+    Args:
+        tt_mx (np.array): 2-D array where (i, j) is the travel time for agent i to facility j.
+
+    Returns:
+        np.array: 2-D array of the same shape as tt_mx with the normalized distances.
+    """
+    D = np.zeros_like(tt_mx)
+    D_max = np.broadcast_to(tt_mx.max(axis=1, keepdims=True), tt_mx.shape)
+    D_min = np.broadcast_to(tt_mx.min(axis=1, keepdims=True), tt_mx.shape)
+
+    D[tt_mx <= D_max] = (np.divide(D_max - tt_mx, D_max - D_min, out=np.zeros_like(D), where=(D_max - D_min) !=0))[tt_mx <= D_max]
+    return D
+
+def composition_utility(x, t, M):
+    """Composition component of the distance_composition preference model, for more details on its defininion see the paper.
+
+    Args:
+        x (np.array): 2-D array where (i, j) is the fraction of agent i's group in facility j.
+        t (np.array): tolerance of each agent, shape = (nr_agents, 1).
+        M (float): penalty for exceeding the tolerance, as defined in the paper.
+
+    Returns:
+        np.array: 2-D array of the same shape as x with the composition utilities.
+    """
+    t = np.broadcast_to(t, x.shape)
+    C = x/t
+    C[x > t] = (M + (1-x)*(1-M)/(1-t))[x > t]
+    return C
+
+def distance_composition(tt_mx, population, facilities, M, C_weight, max_pref_length=None):
     """Distance composition preference model, based on the paper "Mechanisms for increased school segregation relative to residential segregation: a model-based analysis" by Dignum et al.
     Utility is a weighed combination of an agent's distance to each facility and its composition (pct of agent's group, which is controlled by a tolerance parameter). 
     The composition weight is controlled by C_weight, and the distance weight is 1-C_weight.
 
     Args:
         tt_mx (np.array): 2-D array where (i, j) is the travel time for agent i to facility j.
-        population (pd.DataFrame): population dataframe, containing the tolerance parameter for each agent.
+        population (pd.DataFrame): population dataframe, containing the group and tolerance parameter for each agent, indexed by id (rows of tt_mx). Can also be a dataframe of agent classes.
         facilities (pd.DataFrame): facilities dataframe, containing the composition of each facility.
         M (float): penalty for exceeding the tolerance, as defined in the paper.
         C_weight (float): weight of the composition utility.
+        max_pref_length (int, optional): if given, only the top max_pref_length facilities are returned for each agent. Defaults to None (all facilities).
     Returns:
         tuple(np.array, np.array): indices of facilities ordered by preference (indices=ids) and the preference matrix (utility of each facility for each agent)
     """
     # Distance - Normalized by the maximum and minimum travel time for each agent.
-    D = np.zeros_like(tt_mx)
-    D_max = np.broadcast_to(tt_mx.max(axis=1, keepdims=True), (population.shape[0], facilities.shape[0]))
-    D_min = np.broadcast_to(tt_mx.min(axis=1, keepdims=True), (population.shape[0], facilities.shape[0]))
-
-    D[tt_mx <= D_max] = (np.divide(D_max - tt_mx, D_max - D_min, out=np.zeros_like(D), where=(D_max - D_min) !=0))[tt_mx <= D_max]
+    D = normalized_distance(tt_mx)
 
     # Composition - a utility function, for more details on its defininion see the paper.
     x = np.zeros((population.shape[0], facilities.shape[0]))
-    t = np.broadcast_to(population['tolerance'].values.reshape(-1, 1), (population.shape[0], facilities.shape[0]))
-
     for group in population.group.unique():
         x[population[population['group'] == group]['id'].values] = facilities[f'comp_{group}'].values
 
-    C = x/t
-    C[x > t] = (M + (1-x)*(1-M)/(1-t))[x > t]
+    C = composition_utility(x, population['tolerance'].values.reshape(-1, 1), M)
 
     util = C_weight * C + (1-C_weight) * D
     
     # (-util) is used as a trick to sort in descending order
-    return (-util).argsort(), util
+    return sorted_top_k(-util, max_pref_length), util
+
+class DistanceComposition(object):
+    """Stateful version of the distance_composition preference model, for repeated rounds on the same population.
+    The distance component only changes when the network changes, so it is cached together with the agent tolerances and group codes, and re-calculated when
+    the network version changes (Network.add_edge) or a different population is given. Every call only re-calculates the composition component and the blend,
+    in place on preallocated buffers.
+    """
+    def __init__(self, network, M, C_weight, dtype='float64'):
+        """
+        Args:
+            network (Network): the transport network, used to get the travel times of the agents to the facilities.
+            M (float): penalty for exceeding the tolerance, as defined in the paper.
+            C_weight (float): weight of the composition utility.
+            dtype (str, optional): dtype of the utilities, 'float32' halves the memory of the buffers. Defaults to 'float64'.
+        """
+        self.network = network
+        self.M = M
+        self.C_weight = C_weight
+        self.dtype = np.dtype(dtype)
+        # Cached state, see update_distances.
+        self.population = None
+        self.network_version = None
+
+    def update_distances(self, population, facilities):
+        """Re-calculates the cached distance component, tolerances and group codes of the population, and allocates the buffers.
+
+        Args:
+            population (pd.DataFrame): population dataframe (or agent classes), containing the node, group and tolerance of each agent, indexed by id.
+            facilities (pd.DataFrame): facilities dataframe.
+        """
+        # Rows follow the agent ids, as in distance_composition.
+        ids = population['id'].values
+        tt_mx = np.empty((population.shape[0], facilities.shape[0]))
+        tt_mx[ids] = self.network.travel_times(population['node'].values, facilities['node'].values)
+        # (1 - C_weight) * D is all we need from the distance component.
+        self.D = normalized_distance(tt_mx).astype(self.dtype)
+        self.D *= 1 - self.C_weight
+        self.t = np.empty((population.shape[0], 1), dtype=self.dtype)
+        self.t[ids, 0] = population['tolerance'].values
+        # Slope of the composition utility above the tolerance. Agents with tolerance 1 never exceed it, so the division by 0 does not matter.
+        with np.errstate(divide='ignore'):
+            self.slope = (1 - self.M) / (1 - self.t)
+        # Integer group code of each agent, indexing self.groups.
+        group_codes, self.groups = pd.factorize(population['group'])
+        self.group_codes = np.empty(population.shape[0], dtype=group_code_dtype(len(self.groups)))
+        self.group_codes[ids] = group_codes
+        # Buffers: the utilities, x (re-used for the composition utility above the tolerance) and the mask where x exceeds the tolerance.
+        self.util = np.empty(self.D.shape, dtype=self.dtype)
+        self.x = np.empty(self.D.shape, dtype=self.dtype)
+        self.exceeds = np.empty(self.D.shape, dtype=bool)
+        self.population = population
+        self.network_version = self.network.version
+
+    def __call__(self, population, facilities, max_pref_length=None):
+        """Returns the preferences of the population, see distance_composition.
+        Note: the returned utility matrix is a buffer that is overwritten on the next call - copy it to keep it.
+
+        Args:
+            population (pd.DataFrame): population dataframe (or agent classes), containing the node, group and tolerance of each agent, indexed by id.
+            facilities (pd.DataFrame): facilities dataframe, containing the composition of each facility.
+            max_pref_length (int, optional): if given, only the top max_pref_length facilities are returned for each agent. Defaults to None (all facilities).
+        Returns:
+            tuple(np.array, np.array): indices of facilities ordered by preference (indices=ids) and the preference matrix (utility of each facility for each agent)
+        """
+        if population is not self.population or self.network_version != self.network.version:
+            self.update_distances(population, facilities)
+        util, x, exceeds = self.util, self.x, self.exceeds
+
+        # Composition of each facility for each group - (nr_groups, nr_facilities), then picked per agent by group code.
+        group_composition = facilities[[f'comp_{group}' for group in self.groups]].to_numpy(dtype=self.dtype).T
+        np.take(group_composition, self.group_codes, axis=0, out=x)
+
+        # C = x/t below the tolerance, M + (1-x)*(1-M)/(1-t) above it.
+        np.greater(x, self.t, out=exceeds)
+        np.divide(x, self.t, out=util)
+        np.subtract(1, x, out=x)
+        with np.errstate(invalid='ignore'):
+            np.multiply(x, self.slope, out=x)
+        x += self.M
+        np.copyto(util, x, where=exceeds)
+
+        # util = C_weight * C + (1-C_weight) * D
+        util *= self.C_weight
+        util += self.D
+
+        # (-util) is used as a trick to sort in descending order
+        np.negative(util, out=x)
+        return sorted_top_k(x, max_pref_length), util
@@ -1,21 +1,22 @@
 import time
 import numpy as np
 from logger import Logger
+from metrics import MetricSeries, RunningHistogram
 import pandas as pd
-from allocation import first_choice, random_serial_dictatorship
-from evaluation import calculate_ci, dissimilarity_index, facility_capacity, facility_group_composition, facility_rank_distribution, preference_of_allocation, travel_time_to_allocation
-from intervention import create_random_edge, maximize_node_centrality
+from allocation import deferred_acceptance, first_choice, probabilistic_serial, random_serial_dictatorship, random_serial_dictatorship_batch, random_serial_dictatorship_counts, top_trading_cycles
+from evaluation import calculate_ci, dissimilarity_index, evaluate_allocations, facility_capacity, facility_group_composition, facility_rank_distribution, is_fractional, preference_of_allocation, travel_time_to_allocation
+from intervention import create_random_edge, maximize_node_centrality, plan_facility_edges, rank_facility_edges
 import matplotlib
-import seaborn as sns
 
 from plot import get_figure, heatmap_from_numpy
 # Matplotlib stopped working on my machine, so I had to add this line to make it work again.
 matplotlib.use("TKAgg")
 from network import Network
-from preference import distance_composition, distance_popularity, toy_model, nearest_k
+from preference import DistanceComposition, distance_popularity, group_code_dtype, preference_ranks, toy_model, nearest_k
+from seeding import simulation_streams
 
 class Runner(object):
-    def __init__(self, network: Network, population: pd.DataFrame, facilities: pd.DataFrame, logger: Logger):
+    def __init__(self, network: Network, population: pd.DataFrame, facilities: pd.DataFrame, logger: Logger, seed=None):
 
         self.network = network
         self.population = population
@@ -24,7 +25,7 @@ class Runner(object):
 
         self.facilities_size = facilities.shape[0]
         self.population_size = population.shape[0]
-        self.population['group_id'] = population.groupby('group').ngroup()
+        self.population['group_id'] = population.groupby('group').ngroup().astype(group_code_dtype(population['group'].nunique()))
         self.group_sizes = self.population['group_id'].value_counts()
         self.group_names = self.population.groupby('group_id')['group'].first()
         # For each group, we want to know how its population is distributed over the network nodes. This helps us to calculate metrics weighted by group.
@@ -43,26 +44,35 @@ class Runner(object):
         # Attach relevant node attributes to facilities / keep relevant columns using regex.
         # Group composition of a facility in the beginning is the same as the group composition of the node it is located on.
         self.facilities = self.facilities.merge(self.nodes[['node'] + self.comp_columns], on='node')
+        # All randomness of the simulation is derived from this seed sequence (see seeding.simulation_streams). Without a seed, fresh entropy is used - it is logged so that the run can be reproduced.
+        self.seed_sequence = np.random.SeedSequence(seed)
         # Log stuff
         if self.logger:
-            logger.append_to_output_file(f'facilities_size: {self.facilities_size}\npopulation_size: {self.population_size}\ntotal_groups: {self.total_groups}')
+            logger.append_to_output_file(f'facilities_size: {self.facilities_size}\npopulation_size: {self.population_size}\ntotal_groups: {self.total_groups}\nseed: {self.seed_sequence.entropy}')
             for g in self.group_names.index:
                 logger.append_to_output_file(f"Group {self.group_names[g]} size: {self.population[self.population['group_id'] == g].shape[0]}")
 
+        # Agents that share node, group (and tolerance) get identical preferences - preference models run once per such class.
+        self.update_agent_classes()
+        # The distance_composition preference model caches its distance component between rounds, created on first use.
+        self.distance_composition = None
+        # Whether the last generated preference lists were cut off by max_pref_length (see generate_preferences and extend_preferences).
+        self.pref_list_truncated = False
+
         # Calculate travel times for all agents in the population to all facilities.
-        travel_time = self.network.tt_mx[self.population['node'].values][:, [self.facilities['node'].values]].squeeze()
+        travel_time = self.network.travel_times(self.population['node'].values, self.facilities['node'].values)
 
         ## Just a random check if the above indexing works, to remove later on.
         pop_sample = population.sample()
         fac_sample = facilities.sample()
-        assert self.network.tt_mx[pop_sample.iloc[0]['node'], fac_sample.iloc[0]['node']] == travel_time[pop_sample.iloc[0]['id'], fac_sample.iloc[0]['id']], "Something wrong with travel time indexing - incompatible travel times between network pre-calculated and indexed values."
+        assert self.network.travel_times([pop_sample.iloc[0]['node']], [fac_sample.iloc[0]['node']])[0, 0] == travel_time[pop_sample.iloc[0]['id'], fac_sample.iloc[0]['id']], "Something wrong with travel time indexing - incompatible travel times between network pre-calculated and indexed values."
         ##
 
         # Safe a figure of the network to the output folder.
         if self.logger:
             self.logger.save_igraph_plot(self.network, facilities_to_label=self.facilities['node'].values)
 
-    def run_simulation(self, simulation_rounds: int, allocation_rounds: int, intervention_rounds: int, intervention_budget: int, preferences_model: str, allocation_model: str, intervention_model: str, preference_model_params=None, update_preference_params=False):
+    def run_simulation(self, simulation_rounds: int, allocation_rounds: int, intervention_rounds: int, intervention_budget: int, preferences_model: str, allocation_model: str, intervention_model: str, preference_model_params=None, update_preference_params=False, intervention_model_params=None, allocation_model_params=None):
         """Runs a simulation of specified simulation_rounds using specified preferences, allocation and intervention models.
 
         Args:
@@ -75,6 +85,8 @@ class Runner(object):
             intervention_model (str): network intervention model to use.
             preference_model_params (dict, optional): controls hyperparameters of the preference model. Defaults to None.
             update_preference_params (bool, optional): whether to update the preference model parameters after each simulation round. Defaults to False.
+            intervention_model_params (dict, optional): controls hyperparameters of the intervention model. Defaults to None.
+            allocation_model_params (dict, optional): controls hyperparameters of the allocation model. Defaults to None.
         """
 
         # Note: this currently only runs properly for 2 groups.
@@ -88,6 +100,9 @@ class Runner(object):
         ##
 
 
+        # Independent random streams for the setup, and per simulation round for the interventions and each allocation round.
+        setup_rng, intervention_rngs, allocation_rngs = simulation_streams(self.seed_sequence, simulation_rounds, allocation_rounds)
+
         # 
         pop_optimal_grp_frac = preference_model_params['pop_optimal_grp_frac']
         if type(pop_optimal_grp_frac) == float:
@@ -95,25 +110,31 @@ class Runner(object):
 
             self.population['tolerance'] = pop_optimal_grp_frac
         elif type(pop_optimal_grp_frac) == list:
-            self.population['tolerance'] = np.random.choice(pop_optimal_grp_frac, self.population_size)
+            self.population['tolerance'] = setup_rng.choice(pop_optimal_grp_frac, self.population_size)
+        self.update_agent_classes()
 
         # Note: first round is vanilla - no interventions are added.
-        # initialize empty numpy arrays meant to store values of evaluation metrics per simulation round.
-        alloc_by_facility = np.zeros((simulation_rounds, allocation_rounds, self.facilities_size))
-        capacity = np.zeros((simulation_rounds, allocation_rounds, self.facilities_size))
+        # Running statistics (mean and variance over the allocation rounds) of the evaluation metrics per simulation round, see metrics.MetricSeries.
+        # Only the dissimilarity index is kept for every allocation round (it is returned).
+        alloc_by_facility = MetricSeries(simulation_rounds, self.facilities_size)
+        capacity = MetricSeries(simulation_rounds, self.facilities_size)
         popularity = np.zeros((simulation_rounds, self.facilities_size))
-        grp_composition_pct = np.zeros((simulation_rounds, allocation_rounds, self.facilities_size, self.total_groups))
-        grp_composition = np.zeros((simulation_rounds, allocation_rounds, self.facilities_size, self.total_groups))
+        grp_composition_pct = MetricSeries(simulation_rounds, (self.facilities_size, self.total_groups))
+        grp_composition = MetricSeries(simulation_rounds, (self.facilities_size, self.total_groups))
         dissimilarity_index = np.zeros((simulation_rounds, allocation_rounds))
-        avg_pos_by_fac = np.zeros((simulation_rounds, allocation_rounds, self.facilities_size))
+        avg_pos_by_fac = MetricSeries(simulation_rounds, self.facilities_size)
         # Mean travel time to facility for each agent and for each group.
-        mean_tt_to_alloc = np.zeros((simulation_rounds, allocation_rounds))
-        mean_tt_to_alloc_by_grp = np.zeros((simulation_rounds, allocation_rounds, self.total_groups))
-        # Mean utility for each agent and for each group on the assigned facility.
-        mean_agent_utility = np.zeros((simulation_rounds, allocation_rounds, self.population_size))
+        mean_tt_to_alloc = MetricSeries(simulation_rounds)
+        mean_tt_to_alloc_by_grp = MetricSeries(simulation_rounds, self.total_groups)
+        # Mean and median (over the agents of the group) utility of each group on the assigned facility, of the mean utility of each agent over the allocation rounds.
+        mean_group_utility = np.zeros((simulation_rounds, self.total_groups))
+        median_group_utility = np.zeros((simulation_rounds, self.total_groups))
         # Mean position in preferences for allocated facilities for each agent and for each group.
-        mean_pos_of_alloc = np.zeros((simulation_rounds, allocation_rounds))
-        mean_pos_of_alloc_by_grp = np.zeros((simulation_rounds, allocation_rounds, self.total_groups))
+        mean_pos_of_alloc = MetricSeries(simulation_rounds)
+        mean_pos_of_alloc_by_grp = MetricSeries(simulation_rounds, self.total_groups)
+        # Share of the agents that did not get a facility (travel time, position and utility are averaged over the assigned agents only).
+        unassigned_share = MetricSeries(simulation_rounds)
+        group_memberships = self.population['group_id'].values
         interventions = []
         # All the rounds where an intervention happened.
         rounds_with_intervention = []
@@ -123,37 +144,57 @@ class Runner(object):
             # After that, we want to have a total of intervention_rounds evenly spread in the simulations.
             intervention_round = intervention_rounds > 0 and i > 0 and ((i == 1) or i % (simulation_rounds // intervention_rounds) == 0)
             if intervention_round:
-                created_interventions = self.create_interventions(intervention_model, intervention_budget)
+                created_interventions = self.create_interventions(intervention_model, intervention_budget, intervention_model_params, rng=intervention_rngs[i])
                 if created_interventions:
                     interventions.extend(created_interventions)
                 rounds_with_intervention.append(i)
 
-            # Store all preference lists for each allocation round for each agent.
-            # This might break if preferences return less items than the total facility size.
-            pref_lists = np.zeros((allocation_rounds, self.population_size, self.facilities_size))
-            # Store all allocation lists for each allocation round for each agent.
-            alloc_lists = np.zeros((allocation_rounds, self.population_size, self.facilities_size))
-            for j in range(allocation_rounds):
-                pref_list, utility, allocation, eval_metrics = self.run_agent_round(preferences_model, allocation_model, preference_model_params)
-                pref_lists[j] = pref_list
-                alloc_lists[j] = allocation
-                # Log pref_list to a file.
-                if self.logger:
-                    agentpref = self.population.copy()
-                    agentpref['pref_list'] = pref_list.tolist()
-                    self.logger.log_dataframe(agentpref, f'agents_pref_list_{i}.csv', round=i)
-                
-                alloc_by_facility[i][j] = eval_metrics['alloc_by_facility']
-                capacity[i][j] = eval_metrics['capacity']
-                grp_composition_pct[i][j] = eval_metrics['grp_composition_pct']
-                grp_composition[i][j] = eval_metrics['grp_composition']
-                dissimilarity_index[i][j] = eval_metrics['dissimilarity_index']
-                avg_pos_by_fac[i][j] = eval_metrics['avg_pos_by_fac']
-                mean_tt_to_alloc[i][j] = eval_metrics['mean_tt_to_alloc']
-                mean_tt_to_alloc_by_grp[i][j] = eval_metrics['mean_tt_to_alloc_by_group']
-                mean_pos_of_alloc[i][j] = eval_metrics['pref_of_alloc']
-                mean_pos_of_alloc_by_grp[i][j] = eval_metrics['pref_of_alloc_by_group']
-                mean_agent_utility[i][j] = utility[range(self.population_size), allocation.flatten()]
+            # Preferences don't change within a simulation round, so they are generated once and all allocation rounds (lotteries) run as one batch.
+            class_pref_list, class_utility = self.generate_preferences(preferences_model, preference_model_params=preference_model_params, return_utility=True, per_class=True)
+            pref_list, utility = class_pref_list[self.agent_class_idx], class_utility[self.agent_class_idx]
+            # Position of every facility in the preference list of each class, for the preference-position metrics.
+            class_pref_ranks = preference_ranks(class_pref_list, self.facilities_size)
+            if allocation_model == 'probabilistic_serial':
+                # Deterministic expected allocation, computed once on the agent classes (replaces the lotteries).
+                allocations = self.generate_expected_allocation(class_pref_list, extend_preferences=self.extend_preferences(class_pref_list, class_utility, preferences_model))[np.newaxis]
+            elif allocation_model == 'class_random_serial_dictatorship':
+                # Lotteries on the agent classes, returns the nr of agents of each class in each facility per round.
+                allocations = self.generate_class_allocations(class_pref_list, allocation_rounds, extend_preferences=self.extend_preferences(class_pref_list, class_utility, preferences_model), rngs=allocation_rngs[i])
+            else:
+                allocations = self.generate_allocations(pref_list, allocation_model, allocation_rounds, extend_preferences=self.extend_preferences(pref_list, utility, preferences_model), allocation_model_params=allocation_model_params, rngs=allocation_rngs[i])
+            # Log pref_list to a file.
+            if self.logger:
+                agentpref = self.population.copy()
+                agentpref['pref_list'] = pref_list.tolist()
+                self.logger.log_dataframe(agentpref, f'agents_pref_list_{i}.csv', round=i)
+
+            # Evaluate all allocation rounds at once.
+            if allocation_model == 'class_random_serial_dictatorship':
+                # Agents of a class are interchangeable, so the classes are evaluated with the fraction of each class in each facility - aggregate metrics are exact.
+                eval_metrics = self.evaluate_batch(class_pref_list, allocations / self.agent_classes['size'].values[:, np.newaxis], utility=class_utility, per_class=True, pref_ranks=class_pref_ranks)
+                eval_metrics['utility'] = eval_metrics['utility'][:, self.agent_class_idx]
+            else:
+                eval_metrics = self.evaluate_batch(pref_list, allocations, utility=utility, pref_ranks=class_pref_ranks[self.agent_class_idx])
+
+            # Deterministic allocation models return a single allocation, its metrics are the same for all allocation rounds.
+            alloc_by_facility.update(i, eval_metrics['alloc_by_facility'])
+            capacity.update(i, eval_metrics['capacity'])
+            grp_composition_pct.update(i, eval_metrics['grp_composition_pct'])
+            grp_composition.update(i, eval_metrics['grp_composition'])
+            dissimilarity_index[i] = eval_metrics['dissimilarity_index']
+            avg_pos_by_fac.update(i, eval_metrics['avg_pos_by_fac'])
+            mean_tt_to_alloc.update(i, eval_metrics['mean_tt_to_alloc'])
+            mean_tt_to_alloc_by_grp.update(i, eval_metrics['mean_tt_to_alloc_by_group'])
+            mean_pos_of_alloc.update(i, eval_metrics['pref_of_alloc'])
+            mean_pos_of_alloc_by_grp.update(i, eval_metrics['pref_of_alloc_by_group'])
+            unassigned_share.update(i, eval_metrics['unassigned_share'])
+            # Mean utility of each agent over the allocation rounds in which it got a facility (utility is nan for unassigned agents, nan if it never got one).
+            is_assigned = ~np.isnan(eval_metrics['utility'])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                agent_utility = np.where(is_assigned, eval_metrics['utility'], 0).sum(axis=0) / is_assigned.sum(axis=0)
+            for g_id in self.group_names.index:
+                mean_group_utility[i, g_id] = np.nanmean(agent_utility[group_memberships == g_id])
+                median_group_utility[i, g_id] = np.nanmedian(agent_utility[group_memberships == g_id])
 
             if self.logger:
                 # Makes no sense to plot this for a lot of facilities
@@ -175,12 +216,23 @@ class Runner(object):
 
                 # Create a matplotlib plot with the distribution of utility for each agent, based on the assigned facility.
                 # TODO NOTE: This doubles the running time of the simulation, -- I am thinking maybe we can store everything and then plot it all at the end?
+                # Histograms with 10 equal bins over the range of the utilities on the assigned facilities of this round, for the agents and (common bins) for the groups, filled per allocation round (see metrics.RunningHistogram).
+                # Unassigned agents have no utility and are left out.
+                assigned_utility = eval_metrics['utility'][is_assigned]
+                utility_hist = RunningHistogram(assigned_utility.min(), assigned_utility.max(), bins=10)
+                group_utility_hist = [RunningHistogram(assigned_utility.min(), assigned_utility.max(), bins=10) for _ in self.group_names.index]
+                for round_utility, round_assigned in zip(eval_metrics['utility'], is_assigned):
+                    utility_hist.update(round_utility[round_assigned])
+                    for g_id in self.group_names.index:
+                        group_utility_hist[g_id].update(round_utility[round_assigned & (group_memberships == g_id)])
+
                 fig, ax = get_figure(f"Utility distribution for agents on assigned facility - round {i}",
                                 f"{preferences_model} - {allocation_model} - {intervention_model}",
                                 xlabel='Utility',
                                 ylabel='Frequency')
-                sns.histplot(mean_agent_utility[i].flatten(), stat='probability', bins=10)
-                ax.axvline(np.median(mean_agent_utility[i].flatten()), linestyle='dashed', linewidth=1)
+                edges, probabilities = utility_hist.probabilities()
+                ax.hist(edges[:-1], bins=edges, weights=probabilities, edgecolor="white")
+                ax.axvline(np.median(assigned_utility), linestyle='dashed', linewidth=1)
                 self.logger.save_plot(fig, f"agent_utility_distribution_{i}.png", round=i)
 
                 fig, ax = get_figure(f"Utility distribution for groups on assigned facility - round {i}",
@@ -188,16 +240,16 @@ class Runner(object):
                                 xlabel='Utility',
                                 ylabel='Frequency')
                 
-                group_memberships = self.population['group_id'].values
-                sns.histplot([mean_agent_utility[i, :, group_memberships == g_id].flatten() for g_id in self.group_names.index], 
-                                stat='probability',
-                                bins=10, 
-                                ax=ax) 
+                # Fractions of all agents (not of the group), so that the bars of all groups sum to 1.
+                total_count = sum(hist.counts.sum() for hist in group_utility_hist)
+                for g_id in self.group_names.index:
+                    edges = group_utility_hist[g_id].edges
+                    ax.hist(edges[:-1], bins=edges, weights=group_utility_hist[g_id].counts / total_count, color=f"C{g_id}", alpha=.5, edgecolor="white", label=f"Group {self.group_names[g_id]}")
                 
                 for g_id in self.group_names.index:
-                    ax.axvline(np.median(mean_agent_utility[i, :, group_memberships == g_id].flatten()), color=f"C{g_id}", linestyle='dashed', linewidth=1)
+                    ax.axvline(np.nanmedian(eval_metrics['utility'][:, group_memberships == g_id]), color=f"C{g_id}", linestyle='dashed', linewidth=1)
                 
-                ax.legend(labels=[f"Group {self.group_names[g_id]}" for g_id in self.group_names.index])
+                ax.legend()
                 self.logger.save_plot(fig, f"group_utility_distribution_{i}.png", round=i)
 
                 # Filtered out cause its useless when the network is large and increases runtime 10x.
@@ -215,12 +267,12 @@ class Runner(object):
             if update_preference_params:
                 # Keep a record of the popularity of each facility for each round.
                 popularity[i] = self.facilities['popularity'].values
-                # Update the preference parameters for the next round.
-                self.update_preference_parameters(pref_lists, grp_composition_pct[i])
+                # Update the preference parameters for the next round (preferences are the same in all allocation rounds).
+                self.update_preference_parameters(class_pref_ranks, pref_list.shape[1], eval_metrics['grp_composition_pct'], weights=self.agent_classes['size'].values)
 
         if self.logger:
             # Generate group composition plot for each facility (diffrent plots).
-            grpcomp_ci = np.apply_along_axis(calculate_ci, 1, grp_composition_pct)
+            grpcomp_ci = grp_composition_pct.ci()
             for fid in range(self.facilities_size):
                 fig, ax = get_figure(f"Facility {self.facilities.iloc[fid]['facility']} ({fid}) - Group Composition",
                                     f"{preferences_model} - {allocation_model} - {intervention_model}",
@@ -239,6 +291,7 @@ class Runner(object):
             # Generate Dissimilarity Index plot for all facilities.
             diss_ci = np.apply_along_axis(calculate_ci, 1, dissimilarity_index)
             self.logger.log_numpy_array(diss_ci, 'dissimilarity_index.txt')
+            self.logger.log_numpy_array(unassigned_share.ci(), 'unassigned_share.txt')
             fig, ax = get_figure(f"Dissimilarity Index",
                                 f"{preferences_model} - {allocation_model} - {intervention_model}",
                                 xlabel='Simulation round',
@@ -257,7 +310,7 @@ class Runner(object):
                                 xlabel="Simulation round", 
                                 ylabel="Average Preference Position")
             
-            facpref_ci = np.apply_along_axis(calculate_ci, 1, avg_pos_by_fac)
+            facpref_ci = avg_pos_by_fac.ci()
             for fid in range(self.facilities_size):
                 ax.plot(range(simulation_rounds), facpref_ci[:, 0, fid], label=f'Facility {fid}')
                 ax.fill_between(range(simulation_rounds), facpref_ci[:, 1, fid], facpref_ci[:, 2, fid], color='b', alpha=.1)
@@ -266,7 +319,7 @@ class Runner(object):
             self.logger.save_plot(fig, f'average_facility_pref_position.png')
         
             # Generate Capacity plot for all facilities.
-            cap_ci = np.apply_along_axis(calculate_ci, 1, capacity)
+            cap_ci = capacity.ci()
             fig, ax = get_figure(f"Facility Capacity",
                                 f"{preferences_model} - {allocation_model} - {intervention_model}",
                                 xlabel='Simulation round',
@@ -294,7 +347,7 @@ class Runner(object):
                                 f"{preferences_model} - {allocation_model} - {intervention_model}",
                                 xlabel='Simulation round',
                                 ylabel='# allocated agents')
-            mean_alloc = alloc_by_facility.mean(axis=1)
+            mean_alloc = alloc_by_facility.mean()
             for fid in range(self.facilities_size):
                 ax.bar(range(simulation_rounds), mean_alloc[:, fid], label=f'Facility {fid}', bottom=mean_alloc[:, :fid].sum(axis=1))
                 # ax.bar(range(simulation_rounds), mean_alloc[:, 1], label=f'Facility 1', bottom=mean_alloc[:, 0])
@@ -302,8 +355,8 @@ class Runner(object):
             self.logger.save_plot(fig, f'allocated_agents_by_facility.png')
 
             # Generate Mean Travel Time to Allocation plot.
-            mttalloc_ci = np.apply_along_axis(calculate_ci, 1, mean_tt_to_alloc)
-            mttallocgrp_ci = np.apply_along_axis(calculate_ci, 1, mean_tt_to_alloc_by_grp)
+            mttalloc_ci = mean_tt_to_alloc.ci()
+            mttallocgrp_ci = mean_tt_to_alloc_by_grp.ci()
             fig, ax = get_figure(f"Mean Travel Time to Allocated Facility",
                                 f"{preferences_model} - {allocation_model} - {intervention_model}",
                                 xlabel='Simulation round',
@@ -317,8 +370,8 @@ class Runner(object):
             self.logger.save_plot(fig, f'mean_tt_to_allocation.png')
 
             # Generate Mean Position in pref list for allocation plot
-            mposalloc_ci = np.apply_along_axis(calculate_ci, 1, mean_pos_of_alloc)
-            mposallocgrp_ci = np.apply_along_axis(calculate_ci, 1, mean_pos_of_alloc_by_grp)
+            mposalloc_ci = mean_pos_of_alloc.ci()
+            mposallocgrp_ci = mean_pos_of_alloc_by_grp.ci()
             fig, ax = get_figure(f"Mean Position in Preference of Allocated Facility",
                                 f"{preferences_model} - {allocation_model} - {intervention_model}",
                                 xlabel='Simulation round',
@@ -332,28 +385,26 @@ class Runner(object):
             self.logger.save_plot(fig, f'mean_pref_position_of_allocation.png')
 
             # Generate mean utility by group plot.
-            mean_group_utility = mean_agent_utility.mean(axis=1)
             fig, ax = get_figure(f"Mean Utility by Group",
                                 f"{preferences_model} - {allocation_model} - {intervention_model}",
                                 xlabel='Simulation round',
                                 ylabel='Mean Utility')
 
             for g in range(self.total_groups):
-                ax.plot(range(simulation_rounds), mean_group_utility[:, self.population['group_id'] == g].mean(axis=1), label=f'Group {self.group_names[g]}')
+                ax.plot(range(simulation_rounds), mean_group_utility[:, g], label=f'Group {self.group_names[g]}')
             ax.legend()
             ax.set_ylim(0, None)
             # Save the mean utility by group plot.
             self.logger.save_plot(fig, f'mean_utility_by_group.png')
 
             # Generate median utility by group plot.
-            median_group_utility = mean_agent_utility.mean(axis=1) ## still need to calculate the mean over all allocations
             fig, ax = get_figure(f"Median Utility by Group",
                                 f"{preferences_model} - {allocation_model} - {intervention_model}",
                                 xlabel='Simulation round',
                                 ylabel='Median Utility')
 
             for g in range(self.total_groups):
-                ax.plot(range(simulation_rounds), np.median(median_group_utility[:, self.population['group_id'] == g], axis=1), label=f'Group {self.group_names[g]}')
+                ax.plot(range(simulation_rounds), median_group_utility[:, g], label=f'Group {self.group_names[g]}')
             ax.legend()
             ax.set_ylim(0, None)
             # Save the mean utility by group plot.
@@ -367,6 +418,32 @@ class Runner(object):
 
         return dissimilarity_index, rounds_with_intervention
         
+    def extend_preferences(self, pref_list, utility, preferences_model):
+        """Returns a function that gives the full preference list of an agent, for truncated preference lists (max_pref_length). 
+        Agents that run out of options during allocation get their full list from their utility, only when needed.
+        Short lists that are part of the preference model (nearest_k) are not extended - those agents stay unassigned when their k facilities are full.
+        The full list starts with the truncated list, so that the allocation models can resume at its end, even when utilities are tied.
+
+        Args:
+            pref_list (np.array): array of size (nr of agents, nr of preferences) with the (truncated) preference lists.
+            utility (np.array): array of size (nr of agents, nr of facilities) where each facility is assigned a utility score.
+            preferences_model (str): preference model the utility comes from.
+
+        Returns:
+            callable: agent id -> full preference list, or None if the preference lists are not truncated.
+        """
+        if not self.pref_list_truncated or pref_list.shape[1] >= self.facilities_size:
+            return None
+        # The utility of toy_model is a cost (lower is preferred).
+        sign = 1 if preferences_model == 'toy_model' else -1
+
+        def extend(agent):
+            # Listed facilities first, then the unlisted ones in order of utility.
+            rest = (sign * utility[agent]).argsort(kind='stable')
+            return np.concatenate([pref_list[agent], rest[~np.isin(rest, pref_list[agent])]])
+
+        return extend
+
     def run_agent_round(self, preferences_model, allocation_model, preference_model_params=None):
         """Runs a round of preference generation -> allocation generation -> evaluation.
 
@@ -379,25 +456,46 @@ class Runner(object):
             list: preference_list, allocation, capacity_eval, diversity_eval
         """
         pref_list, utility = self.generate_preferences(preferences_model, preference_model_params=preference_model_params, return_utility=True)
-        allocation = self.generate_allocation(pref_list, allocation_model)
+        allocation = self.generate_allocation(pref_list, allocation_model, extend_preferences=self.extend_preferences(pref_list, utility, preferences_model))
         eval_metrics = self.evaluate(pref_list, allocation)
 
         return pref_list, utility, allocation, eval_metrics
 
-    def generate_preferences(self, preferences_model: str, preference_model_params=None, return_utility=False):
+    def update_agent_classes(self):
+        """Groups the agents into equivalence classes of (node, group, tolerance). Agents of the same class have identical travel times and utilities in all preference models,
+        so preferences only need to be generated once per class. Should be called whenever one of these agent attributes changes.
+        Sets self.agent_classes (dataframe with one row per class and its size) and self.agent_class_idx (the class of each agent).
+        """
+        class_columns = ['node', 'group', 'group_id'] + (['tolerance'] if 'tolerance' in self.population.columns else [])
+        agent_groups = self.population.groupby(class_columns, sort=True)
+        self.agent_class_idx = agent_groups.ngroup().to_numpy(dtype=np.int32)
+        self.agent_classes = agent_groups.size().rename('size').reset_index()
+        # Preference models index agents by id, so the classes get ids too.
+        self.agent_classes['id'] = self.agent_classes.index
+
+    def generate_preferences(self, preferences_model: str, preference_model_params=None, return_utility=False, per_class=False):
         """Generates preferences for each agent in the population, according to preferences_model.
+        Preferences are generated once per agent class (see update_agent_classes) and expanded to the agents by index.
 
         Args:
             preferences_model (str): preference model to use.
             preference_model_params (dict, optional): controls hyperparameters of the preference model. Defaults to None.
             return_utility (bool, optional): whether to return the utility of each agent (the score assigned to each facility). Defaults to False.
+            per_class (bool, optional): whether to return the preferences per agent class instead of per agent (rows follow self.agent_classes, agents map to them with self.agent_class_idx). Defaults to False.
         Returns:
             - np.array: array of size (nr of agents, nr of facilities) where each facility is sorted by preference.
             - np.array: array of size (nr of agents, nr of facilities) where each facility is assigned a utility score.
         """
         pref_list = None
         utility = None
-        travel_time = self.network.tt_mx[self.population['node'].values][:, [self.facilities['node'].values]].squeeze()
+        classes = self.agent_classes
+        # Optionally only keep the top max_pref_length facilities of each agent.
+        max_pref_length = (preference_model_params or {}).get('max_pref_length', None)
+        # nearest_k lists are short by design, only max_pref_length truncates them.
+        self.pref_list_truncated = preferences_model != 'nearest_k' and max_pref_length is not None and max_pref_length < self.facilities_size
+        # distance_composition gets the travel times itself (only when the network changed).
+        if preferences_model != 'distance_composition':
+            travel_time = self.network.travel_times(classes['node'].values, self.facilities['node'].values)
         if preferences_model == 'nearest_k':
             assert 'nearest_k' in preference_model_params.keys(), 'You need to specify nearest_k parameter in config.'
             pref_list, utility = nearest_k(travel_time, k=preference_model_params['nearest_k'])
@@ -405,33 +503,44 @@ class Runner(object):
             assert 'quality' in self.facilities.columns, 'To use the toy_model preference model, the facilities_file should contain a column named "quality".'
             # Select facility qualities
             qualities = self.facilities['quality'].to_numpy()
-            pref_list, utility = toy_model(travel_time, qualities)
+            pref_list, utility = toy_model(travel_time, qualities, max_pref_length=max_pref_length)
         elif preferences_model == 'distance_popularity':
             assert 'popularity' in self.facilities.columns, 'To use the distance_popularity preference model, the facilities_file should contain a column named "popularity".'
             # Select facility popularities
             popularity = self.facilities['popularity'].to_numpy()
-            pref_list, utility = distance_popularity(travel_time, popularity)
+            pref_list, utility = distance_popularity(travel_time, popularity, max_pref_length=max_pref_length)
         elif preferences_model == 'distance_composition':
-            assert 'tolerance' in self.population.columns, 'To use the distance_composition preference model, the population of agents should contain a column named "tolerance".'
+            assert 'tolerance' in classes.columns, 'To use the distance_composition preference model, the population of agents should contain a column named "tolerance".'
             # Select facility compositions
-            pref_list, utility = distance_composition(travel_time, self.population, self.facilities, M=preference_model_params['M'], C_weight=preference_model_params['c_weight'])
+            utility_dtype = preference_model_params.get('utility_dtype', 'float64')
+            if self.distance_composition is None or (self.distance_composition.M, self.distance_composition.C_weight, self.distance_composition.dtype) != (preference_model_params['M'], preference_model_params['c_weight'], utility_dtype):
+                self.distance_composition = DistanceComposition(self.network, M=preference_model_params['M'], C_weight=preference_model_params['c_weight'], dtype=utility_dtype)
+            pref_list, utility = self.distance_composition(classes, self.facilities, max_pref_length=max_pref_length)
 
         assert pref_list is not None, 'No preference list was generated, specify a valid preferences_model parameter in config.'
+
+        if not per_class:
+            # Expand the class rows to agent rows.
+            pref_list = pref_list[self.agent_class_idx]
+            utility = utility[self.agent_class_idx]
         
         if return_utility:
             return pref_list, utility
         else: 
             return pref_list
     
-    def generate_allocation(self, pref_list, allocation_model):
+    def generate_allocation(self, pref_list, allocation_model, extend_preferences=None, allocation_model_params=None, rng=None):
         """Generates allocation of facilities to agents according to allocation_model.
 
         Args:
-            pref_list (np.array): array of size (nr of agents, nr of facilities) where each facility is sorted by preference.
+            pref_list (np.array): array of size (nr of agents, nr of preferences) where each facility is sorted by preference.
             allocation_model (str): allocation model to use.
+            extend_preferences (callable, optional): returns the full preference list of an agent, for truncated preference lists (see random_serial_dictatorship). Defaults to None.
+            allocation_model_params (dict, optional): controls hyperparameters of the allocation model. Defaults to None.
+            rng (np.random.Generator, optional): random generator for the lottery. Defaults to None (numpy's global random state).
 
         Returns:
-            np.array: array of size  (nr_agents, 1) where each agent is assigned to one facility.
+            np.array: array of size  (nr_agents, 1) where each agent is assigned to one facility (or (nr_agents, nr_facilities) assignment probabilities for probabilistic_serial).
         """
         # Assign agents to facilities using an allocation model.
         allocation = None
@@ -439,23 +548,105 @@ class Runner(object):
             allocation = first_choice(pref_list)
         elif allocation_model == 'random_serial_dictatorship':
             capacities = self.facilities.capacity.copy().to_numpy()
-            allocation = random_serial_dictatorship(pref_list, capacities)
+            allocation = random_serial_dictatorship(pref_list, capacities, extend_preferences=extend_preferences, rng=rng)
+        elif allocation_model in ['deferred_acceptance', 'top_trading_cycles']:
+            if allocation_model_params is None: allocation_model_params = {}
+            capacities = self.facilities.capacity.copy().to_numpy()
+            # Facility priorities, ties (or everything, without priorities) are broken by lottery.
+            priorities = None
+            if allocation_model_params.get('priority', None) == 'proximity':
+                # Agents closer to the facility have priority.
+                priorities = self.network.travel_times(self.population['node'].values, self.facilities['node'].values)
+            mechanism = deferred_acceptance if allocation_model == 'deferred_acceptance' else top_trading_cycles
+            allocation = mechanism(pref_list, capacities, priorities=priorities, tie_breaking=allocation_model_params.get('tie_breaking', 'single'), extend_preferences=extend_preferences, rng=rng)
+        elif allocation_model == 'probabilistic_serial':
+            allocation = probabilistic_serial(pref_list, self.facilities.capacity.to_numpy(), np.ones(len(pref_list)), extend_preferences=extend_preferences)
         
         assert allocation is not None, 'No allocation list was generated, specify a valid allocation_model parameter in config.'
         return allocation
 
+    def generate_allocations(self, pref_list, allocation_model, nr_rounds, extend_preferences=None, allocation_model_params=None, rngs=None):
+        """Generates nr_rounds allocations of facilities to agents for the same preferences, according to allocation_model (batched where the model supports it).
+
+        Args:
+            pref_list (np.array): array of size (nr of agents, nr of preferences) where each facility is sorted by preference.
+            allocation_model (str): allocation model to use.
+            nr_rounds (int): nr of allocations to generate.
+            extend_preferences (callable, optional): returns the full preference list of an agent, for truncated preference lists (see random_serial_dictatorship). Defaults to None.
+            allocation_model_params (dict, optional): controls hyperparameters of the allocation model. Defaults to None.
+            rngs (list, optional): one random generator per round, so that each round is reproducible on its own (also with n_jobs > 1). Defaults to None (numpy's global random state).
+
+        Returns:
+            np.array: array of size (nr_rounds, nr_agents, 1) where each agent is assigned to one facility in every round. Deterministic models (first_choice, probabilistic_serial) return a single round.
+        """
+        if allocation_model_params is None: allocation_model_params = {}
+        if allocation_model in ['first_choice', 'probabilistic_serial']:
+            return self.generate_allocation(pref_list, allocation_model, extend_preferences=extend_preferences)[np.newaxis]
+        if allocation_model == 'random_serial_dictatorship':
+            capacities = self.facilities.capacity.to_numpy()
+            allocations = random_serial_dictatorship_batch(pref_list, capacities, nr_rounds, extend_preferences=extend_preferences, n_jobs=allocation_model_params.get('n_jobs', 1), rngs=rngs)
+            return allocations[..., np.newaxis]
+
+        return np.array([self.generate_allocation(pref_list, allocation_model, extend_preferences=extend_preferences, allocation_model_params=allocation_model_params, rng=rngs[r] if rngs is not None else None) for r in range(nr_rounds)])
+
+    def generate_expected_allocation(self, class_pref_list, extend_preferences=None):
+        """Generates the expected (fractional) allocation of the probabilistic_serial allocation model, on the agent classes (see update_agent_classes).
+
+        Args:
+            class_pref_list (np.array): array of size (nr of agent classes, nr of preferences) where each facility is sorted by preference.
+            extend_preferences (callable, optional): returns the full preference list of a class, for truncated preference lists. Defaults to None.
+
+        Returns:
+            np.array: array of size (nr_agents, nr_facilities) with the probability of each agent to be assigned to each facility.
+        """
+        probabilities = probabilistic_serial(class_pref_list, self.facilities.capacity.to_numpy(), self.agent_classes['size'].values, extend_preferences=extend_preferences)
+        return probabilities[self.agent_class_idx]
+
+    def generate_class_allocations(self, class_pref_list, nr_rounds, extend_preferences=None, rngs=None):
+        """Generates nr_rounds random serial dictatorship lotteries on the agent classes (see update_agent_classes), without going through the individual agents.
+
+        Args:
+            class_pref_list (np.array): array of size (nr of agent classes, nr of preferences) where each facility is sorted by preference.
+            nr_rounds (int): nr of lotteries to run.
+            extend_preferences (callable, optional): returns the full preference list of a class, for truncated preference lists. Defaults to None.
+            rngs (list, optional): one random generator per round. Defaults to None (seeded from numpy's global random state).
+
+        Returns:
+            np.array: array of size (nr_rounds, nr of agent classes, nr_facilities) with the nr of agents of each class assigned to each facility.
+        """
+        capacities = self.facilities.capacity.to_numpy()
+        if rngs is None: rngs = [None] * nr_rounds
+        return np.array([random_serial_dictatorship_counts(class_pref_list, capacities, self.agent_classes['size'].values, extend_preferences=extend_preferences, rng=rngs[r]) for r in range(nr_rounds)])
+
     # def softmax(self, x):
     #     # TODO MOVE
     #     return(np.exp(x)/np.exp(x).sum())
 
     
-    def create_interventions(self, intervention_model: str, intervention_budget: int):
+    def create_interventions(self, intervention_model: str, intervention_budget: int, intervention_model_params=None, rng=None):
         """Creates and adds an intervention (new edge) to the network, according to the intervention_model
 
         Args:
             intervention_model (str): network intervention model to use.
+            intervention_budget (int): nr of interventions (new edges) to create.
+            intervention_model_params (dict, optional): controls hyperparameters of the intervention model. Defaults to None.
+            rng (np.random.Generator, optional): random generator for the random intervention model. Defaults to None (numpy's global random state).
         """
         created_interventions = []
+        if intervention_model_params is None: intervention_model_params = {}
+        # Nr of worker processes to score candidate edges with (for centrality measures that are not scored analytically).
+        n_jobs = intervention_model_params.get('n_jobs', 1)
+        # Optional spatial filter of the candidate edges (only for networks with x/y node coordinates).
+        candidate_filter = {'k_nearest': intervention_model_params.get('candidate_k_nearest', None), 'max_length': intervention_model_params.get('candidate_max_length', None)}
+
+        if intervention_model in ['greedy_closeness', 'greedy_group_closeness']:
+            # Plans the whole budget at once with a greedy search over the total (group) closeness of all facilities - the edges are added by the planner.
+            centrality_measure = intervention_model.replace('greedy_', '')
+            group_weights = np.array([self.group_node_distr[gid].values for gid in self.group_names.index]) if centrality_measure == 'group_closeness' else None
+            created_interventions = plan_facility_edges(self.network, self.facilities['node'].values, centrality_measure, intervention_budget, group_weights=group_weights, candidate_filter=candidate_filter)
+            for e in created_interventions:
+                print(f'adding ({e.source}, {e.target}) edge')
+            return created_interventions
 
         for _ in range(intervention_budget):
             x, y, w = None, None, None
@@ -463,19 +654,19 @@ class Runner(object):
             if intervention_model == 'none':
                 return
             elif intervention_model == 'random':
-                x, y, w = create_random_edge(self.network)
+                x, y, w = create_random_edge(self.network, rng=rng)
             elif intervention_model == 'closeness':
                 # Find the facility with the lowest closeness centrality to augment, then find the edge that maximizes that node's centrality.
                 node_to_augment = fac_nodes[np.argmin(self.network.network.closeness(fac_nodes))].item()
-                x, y, w = maximize_node_centrality(self.network, node_to_augment, 'closeness')
+                x, y, w = maximize_node_centrality(self.network, node_to_augment, 'closeness', candidate_filter=candidate_filter)
             elif intervention_model == 'betweenness':
                 # Find the facility with the lowest betweenness centrality to augment, then find the edge that maximizes that node's centrality.
                 node_to_augment = fac_nodes[np.argmin(self.network.network.betweenness(fac_nodes))].item()
-                x, y, w = maximize_node_centrality(self.network, node_to_augment, 'betweenness')
+                x, y, w = maximize_node_centrality(self.network, node_to_augment, 'betweenness', n_jobs=n_jobs, candidate_filter=candidate_filter)
             elif intervention_model == 'degree':
                 # Find the facility with the lowest degree centrality to augment, then find the edge that maximizes that node's centrality.
                 node_to_augment = fac_nodes[np.argmin(self.network.network.degree(fac_nodes))].item()
-                x, y, w = maximize_node_centrality(self.network, node_to_augment, 'degree')
+                x, y, w = maximize_node_centrality(self.network, node_to_augment, 'degree', n_jobs=n_jobs, candidate_filter=candidate_filter)
             elif intervention_model == 'group_closeness':
                 group_closenesses = np.array([self.network.weighted_closeness(fac_nodes, weights=self.group_node_distr[gid].values) for gid in self.group_names.index])
                 # Returns a tuple of (group_id, node_id) where node_id is the node with the lowest closeness with respect to group_id.
@@ -499,21 +690,34 @@ class Runner(object):
                 # node_to_augment = fac_nodes[node_idx_to_augment].item()
                 ######
 
-                x, y, w = maximize_node_centrality(self.network, node_to_augment, 'group_closeness', group_weights=self.group_node_distr[grp_to_augment].values)
+                x, y, w = maximize_node_centrality(self.network, node_to_augment, 'group_closeness', group_weights=self.group_node_distr[grp_to_augment].values, n_jobs=n_jobs, candidate_filter=candidate_filter)
             elif intervention_model == 'group_betweenness':
-                group_betweenness = np.array([self.network.weighted_betweeness(fac_nodes, weights=self.group_node_distr[gid].values) for gid in self.group_names.index])
+                # One traversal for all groups: weights is a (groups x nodes) matrix.
+                group_betweenness = self.network.weighted_betweeness(fac_nodes, weights=np.array([self.group_node_distr[gid].values for gid in self.group_names.index]))
                 # Returns a tuple of (group_id, node_id) where node_id is the node with the lowest betweenness with respect to group_id.
                 grp_to_augment, node_idx_to_augment = np.unravel_index(group_betweenness.argmin(), group_betweenness.shape)
                 # node_idx_to_augment is the index of the node in the group_node_distr array, we need to get the actual node id.
                 node_to_augment = fac_nodes[node_idx_to_augment].item()
-                x, y, w = maximize_node_centrality(self.network, node_to_augment, 'group_betweenness', group_weights=self.group_node_distr[grp_to_augment].values)
+                # Slow: the group betweenness is recalculated over the whole network for every candidate edge (see maximize_node_centrality).
+                x, y, w = maximize_node_centrality(self.network, node_to_augment, 'group_betweenness', group_weights=self.group_node_distr[grp_to_augment].values, n_jobs=n_jobs, candidate_filter=candidate_filter)
             elif intervention_model == 'group_degree':
                 group_degree = np.array([self.network.weighted_degree(fac_nodes, weights=self.group_node_distr[gid].values) for gid in self.group_names.index])
                 # Returns a tuple of (group_id, node_id) where node_id is the node with the lowest degree with respect to group_id.
                 grp_to_augment, node_idx_to_augment = np.unravel_index(group_degree.argmin(), group_degree.shape)
                 # node_idx_to_augment is the index of the node in the group_node_distr array, we need to get the actual node id.
                 node_to_augment = fac_nodes[node_idx_to_augment].item()
-                x, y, w = maximize_node_centrality(self.network, node_to_augment, 'group_degree', group_weights=self.group_node_distr[grp_to_augment].values)
+                x, y, w = maximize_node_centrality(self.network, node_to_augment, 'group_degree', group_weights=self.group_node_distr[grp_to_augment].values, n_jobs=n_jobs, candidate_filter=candidate_filter)
+            elif intervention_model in ['global_closeness', 'global_group_closeness']:
+                # Search the candidate edges of all facilities (and groups) in one pass, instead of only the ones of the facility with the lowest centrality.
+                centrality_measure = intervention_model.replace('global_', '')
+                group_weights = np.array([self.group_node_distr[gid].values for gid in self.group_names.index]) if centrality_measure == 'group_closeness' else None
+                top_edges = rank_facility_edges(self.network, fac_nodes, centrality_measure, group_weights=group_weights, top_k=intervention_model_params.get('top_k', 10), candidate_filter=candidate_filter)
+                # Keep the ranked alternatives, so they can be inspected without re-running.
+                if self.logger:
+                    self.logger.append_to_output_file(f"{intervention_model} top edges (gain, x, y, group_id): {top_edges}")
+                if len(top_edges) > 0 and top_edges[0][0] > 0:
+                    _, x, y, _ = top_edges[0]
+                    w = 1
             else:
                 assert False, 'No intervention was generated, specify a valid intervention_model parameter in config.'
 
@@ -535,12 +739,15 @@ class Runner(object):
         Returns:
             dit: dictionary of evaluation metrics.
         """
+        travel_time = self.network.travel_times(self.population['node'].values, self.facilities['node'].values)
         alloc_by_facility, capacity = facility_capacity(self.population, self.facilities, allocation)
         grp_composition, grp_composition_pct = facility_group_composition(self.population, self.facilities, allocation)
         facility_rank_distr, avg_pos_by_fac = facility_rank_distribution(pref_list, self.facilities_size, return_avg_pos_by_fac=True)
         di = dissimilarity_index(self.population, self.facilities, allocation, grp_composition)
-        mean_tt_to_alloc, mean_tt_to_alloc_by_group = travel_time_to_allocation(self.network.tt_mx, self.population, self.facilities, allocation, return_group_avg=True, groups=self.group_names)
+        mean_tt_to_alloc, mean_tt_to_alloc_by_group = travel_time_to_allocation(travel_time, self.population, self.facilities, allocation, return_group_avg=True, groups=self.group_names)
         pref_of_alloc, pref_of_alloc_by_group = preference_of_allocation(pref_list, allocation, return_group_avg=True, group_membership=self.population['group_id'].values)
+        # Share of the agents without a facility (-1, e.g. when there are more agents than seats).
+        unassigned_share = 1 - allocation.sum() / len(allocation) if is_fractional(allocation) else (allocation < 0).mean()
 
         return {
             'alloc_by_facility': alloc_by_facility,
@@ -553,16 +760,38 @@ class Runner(object):
             'mean_tt_to_alloc': mean_tt_to_alloc,
             'mean_tt_to_alloc_by_group': mean_tt_to_alloc_by_group,
             'pref_of_alloc': pref_of_alloc,
-            'pref_of_alloc_by_group': pref_of_alloc_by_group
+            'pref_of_alloc_by_group': pref_of_alloc_by_group,
+            'unassigned_share': unassigned_share
         }
 
-    def update_preference_parameters(self, pref_lists, grp_composition_pct):
+    def evaluate_batch(self, pref_list, allocations, utility=None, per_class=False, pref_ranks=None):
+        """Evaluates a stack of allocations for the same preferences (all allocation rounds of a simulation round) in one pass, see evaluation.evaluate_allocations.
+
+        Args:
+            pref_list (np.array): array of size (nr of agents, nr of preferences) where each facility is sorted by preference.
+            allocations (np.array): array of size (nr_rounds, nr_agents, 1) where each agent is assigned to one facility in every round (or (nr_rounds, nr_agents, nr_facilities) for fractional allocations).
+            utility (np.array, optional): array of size (nr of agents, nr of facilities) with the utility of each facility. Defaults to None.
+            per_class (bool, optional): whether the rows are the agent classes (see update_agent_classes) instead of the agents - the allocations are then the fraction of each class in each facility. Defaults to False.
+            pref_ranks (np.array, optional): rank matrix of pref_list (see preference.preference_ranks). Defaults to None (computed from pref_list).
+
+        Returns:
+            dict: dictionary of evaluation metrics, each with a leading nr_rounds axis.
+        """
+        agents = self.agent_classes if per_class else self.population
+        weights = self.agent_classes['size'].values if per_class else None
+        travel_time = self.network.travel_times(agents['node'].values, self.facilities['node'].values)
+
+        return evaluate_allocations(allocations, pref_list, travel_time, agents['group_id'].values, self.facilities['capacity'].values, self.total_groups, utility=utility, weights=weights, pref_ranks=pref_ranks)
+
+    def update_preference_parameters(self, pref_ranks, pref_length, grp_composition_pct, weights=None):
         """
         Updates parameters related to the preference models, such as popularity, group composition, etc. It should only run if dynamic_preference_model is set to True.
 
         Args:
-            pref_lists (np.array): array of size (allocation_rounds, nr_agents, nr_facilities) where each agent has a list of preferences.
+            pref_ranks (np.array): array of size (nr_agents, nr_facilities) with the position of each facility in the preference list of each agent (see preference.preference_ranks).
+            pref_length (int): length of the preference lists (facilities with this rank are not listed).
             grp_composition_pct (np.array): array of size (allocation_rounds, nr_facilities, nr_groups) where each facility has a group composition.
+            weights (np.array, optional): nr of agents each row of pref_ranks stands for (agent classes). Defaults to None (one agent per row).
 
         Returns:
             None
@@ -571,7 +800,10 @@ class Runner(object):
         # 1. Add +1 to positions to avoid division by zero.
         # 2. Get the reciprical of the positions, so that the first choice has the highest weight.
         # 3. Calculate a weighted avg of the preferences for each facility, set this as the new popularity.
-        popularity = [np.mean(1/(np.where(pref_lists == f)[2] + 1)) for f in self.facilities['id'].values]
+        # Facilities missing from truncated preference lists count as 0 (the average is over all lists).
+        if weights is None:
+            weights = np.ones(pref_ranks.shape[0])
+        popularity = np.where(pref_ranks < pref_length, 1 / (pref_ranks + 1.0), 0).T @ weights / weights.sum()
         self.facilities['popularity'] = popularity
 
         # Average over all the allocation rounds to get the average group composition per facility.
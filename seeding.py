@@ -0,0 +1,36 @@
+import numpy as np
+
+def spawn_generators(seed_sequence: np.random.SeedSequence, n: int):
+    """Spawns n independent random generators from a seed sequence.
+
+    Args:
+        seed_sequence (np.random.SeedSequence): the seed sequence to spawn from (its spawn counter advances, so every call gives new streams).
+        n (int): nr of generators to spawn.
+
+    Returns:
+        list: list of n np.random.Generator.
+    """
+    return [np.random.default_rng(s) for s in seed_sequence.spawn(n)]
+
+def simulation_streams(seed_sequence: np.random.SeedSequence, simulation_rounds: int, allocation_rounds: int):
+    """Derives the random streams of a simulation from a seed sequence: one for the setup (e.g. sampling tolerances) and, for every simulation round,
+    one for the interventions and one per allocation round. Each stream only depends on the seed and its position in the simulation,
+    so results are the same no matter in which order (or on how many workers) the rounds run.
+
+    Args:
+        seed_sequence (np.random.SeedSequence): root seed sequence of the simulation.
+        simulation_rounds (int): nr of simulation rounds.
+        allocation_rounds (int): nr of allocation rounds per simulation round.
+
+    Returns:
+        tuple: (setup_rng, intervention_rngs, allocation_rngs) where intervention_rngs is a list of simulation_rounds generators and
+            allocation_rngs a list of simulation_rounds lists of allocation_rounds generators.
+    """
+    setup_seq, rounds_seq = seed_sequence.spawn(2)
+    intervention_rngs, allocation_rngs = [], []
+    for round_seq in rounds_seq.spawn(simulation_rounds):
+        intervention_seq, allocation_seq = round_seq.spawn(2)
+        intervention_rngs.append(np.random.default_rng(intervention_seq))
+        allocation_rngs.append(spawn_generators(allocation_seq, allocation_rounds))
+
+    return np.random.default_rng(setup_seq), intervention_rngs, allocation_rngs
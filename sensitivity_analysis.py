@@ -113,8 +113,8 @@ for c_weight in np.arange(0, 1, 0.1):
             population = pd.read_csv(f'{env}/{population_file}')
             facilities = pd.read_csv(f'{env}/{facilities_file}')
             
-            network = Network(f'{env}/{network_file}', calc_tt_mx=True)
-            runner = Runner(network, population, facilities, logger=None)
+            network = Network(f'{env}/{network_file}', calc_tt_mx=True, tt_cache=True)
+            runner = Runner(network, population, facilities, logger=None, seed=seed)
 
             di, rwi = runner.run_simulation(
                     simulation_rounds,
@@ -175,7 +175,7 @@ def di_progress_by_param(env, pref_model, alloc_model, inter_model, sim_rounds,
         for optimal_group_fraction in opt_group_frac:
             print(f'c_weight={c_weight}, optimal_group_fraction={optimal_group_fraction}')
 
-            network = Network(f'{env}/{network_file}', calc_tt_mx=True)
+            network = Network(f'{env}/{network_file}', calc_tt_mx=True, tt_cache=True)
             population = pd.read_csv(f'{env}/{population_file}')
             facilities = pd.read_csv(f'{env}/{facilities_file}')
             runner = Runner(network, population, facilities, logger=None)
@@ -309,7 +309,7 @@ def di_progress_by_inter_model(env, pref_model, alloc_model, inter_models: list,
         for inter_model in inter_models:
             print(f'c_weight={c_weight}, intervention model={inter_model}')
 
-            network = Network(f'{env}/{network_file}', calc_tt_mx=True)
+            network = Network(f'{env}/{network_file}', calc_tt_mx=True, tt_cache=True)
             population = pd.read_csv(f'{env}/{population_file}')
             facilities = pd.read_csv(f'{env}/{facilities_file}')
             runner = Runner(network, population, facilities, logger=None)
@@ -392,7 +392,7 @@ for m in modularity:
     p_out = np.round(0.06 - m, 3)
 
     env = f'./envs/sbm/SBM_2_50_{p_in}_{p_out}_pop_1500_0.5_[0.8]_{42}'
-    network = Network(f'{env}/{network_file}', calc_tt_mx=True)
+    network = Network(f'{env}/{network_file}', calc_tt_mx=True, tt_cache=True)
 
     print(f'm: {m}')
     print(f'Nodes: {network.network.vcount()}')
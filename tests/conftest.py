@@ -0,0 +1,36 @@
+import os
+import sys
+
+import igraph as ig
+import numpy as np
+import pytest
+
+# The modules live in the repository root (no package), so the tests import them from there.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from network import Network
+
+
+def random_graph(nr_nodes, nr_extra_edges, rng, weighted=True):
+    """Returns a connected random graph: a ring with nr_extra_edges random chords, with random edge weights (travel times)."""
+    edges = {(i, (i + 1) % nr_nodes) for i in range(nr_nodes)}
+    while len(edges) < nr_nodes + nr_extra_edges:
+        u, v = sorted(rng.choice(nr_nodes, 2, replace=False).tolist())
+        if (v, u) not in edges:
+            edges.add((u, v))
+    graph = ig.Graph(n=nr_nodes, edges=sorted(edges))
+    if weighted:
+        graph.es['weight'] = rng.uniform(1, 5, len(graph.es)).round(2).tolist()
+    return graph
+
+
+@pytest.fixture
+def make_network(tmp_path):
+    """Factory that writes a random graph to a .gml file in tmp_path and loads it as a Network."""
+    def make(nr_nodes=20, nr_extra_edges=15, seed=0, weighted=True, **kwargs):
+        graph = random_graph(nr_nodes, nr_extra_edges, np.random.default_rng(seed), weighted=weighted)
+        path = str(tmp_path / f'network_{seed}.gml')
+        graph.write_gml(path)
+        return Network(path, **kwargs)
+
+    return make
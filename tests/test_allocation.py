@@ -0,0 +1,203 @@
+import numpy as np
+import pytest
+
+import allocation
+from allocation import deferred_acceptance, probabilistic_serial, random_serial_dictatorship, random_serial_dictatorship_counts, top_trading_cycles
+from evaluation import evaluate_allocations
+
+
+def random_instance(seed, nr_agents=30, nr_facilities=6, nr_preferences=3, total_capacity=None):
+    """Full random preference lists, their first nr_preferences facilities (the truncated lists) and random capacities (at least one seat each)."""
+    rng = np.random.default_rng(seed)
+    full_pref_list = np.array([rng.permutation(nr_facilities) for _ in range(nr_agents)])
+    total_capacity = nr_agents + 4 if total_capacity is None else total_capacity
+    capacities = 1 + np.bincount(rng.integers(nr_facilities, size=total_capacity - nr_facilities), minlength=nr_facilities)
+    return full_pref_list, full_pref_list[:, :nr_preferences].copy(), capacities
+
+
+def first_available(prefs, remaining_capacity):
+    return next((f for f in prefs if remaining_capacity[f] > 0), -1)
+
+
+def naive_serial_dictatorship(pref_list, capacities, lottery):
+    remaining_capacity = capacities.copy()
+    assignments = np.full(len(pref_list), -1)
+    for agent in lottery:
+        facility = first_available(pref_list[agent], remaining_capacity)
+        if facility >= 0:
+            assignments[agent] = facility
+            remaining_capacity[facility] -= 1
+    return assignments
+
+
+def priority_keys(nr_agents, nr_facilities, priorities, tie_breaking, seed):
+    """(priority, lottery) of each agent at each facility, drawn the same way as the mechanisms draw their lottery (lower is better)."""
+    lottery = allocation._draw_tie_breaking(nr_agents, nr_facilities, tie_breaking, np.random.default_rng(seed))
+    lottery = np.tile(lottery[:, np.newaxis], (1, nr_facilities)) if lottery.ndim == 1 else lottery
+    priorities = np.zeros((nr_agents, nr_facilities)) if priorities is None else priorities
+    return [[(priorities[a, f], lottery[a, f]) for f in range(nr_facilities)] for a in range(nr_agents)]
+
+
+def naive_deferred_acceptance(pref_list, capacities, keys):
+    # One proposal at a time, the agent-optimal stable matching does not depend on the order of the proposals.
+    held = [[] for _ in capacities]
+    next_choice = [0] * len(pref_list)
+    free = list(range(len(pref_list)))
+    while free:
+        agent = free.pop()
+        if next_choice[agent] == len(pref_list[agent]):
+            continue
+        facility = pref_list[agent][next_choice[agent]]
+        next_choice[agent] += 1
+        held[facility] = sorted(held[facility] + [agent], key=lambda a: keys[a][facility])
+        if len(held[facility]) > capacities[facility]:
+            free.append(held[facility].pop())
+
+    assignments = np.full(len(pref_list), -1)
+    for facility, agents in enumerate(held):
+        assignments[agents] = facility
+    return assignments
+
+
+def naive_top_trading_cycles(pref_list, capacities, keys):
+    # Clears all cycles of a round at once, with strict priorities the matching does not depend on the order of the cycles.
+    remaining_capacity = capacities.copy()
+    assignments = np.full(len(pref_list), -1)
+    left = set(range(len(pref_list)))
+    while left:
+        points_to = {a: first_available(pref_list[a], remaining_capacity) for a in left}
+        left -= {a for a, f in points_to.items() if f < 0}
+        if not left:
+            break
+        top_agent = {f: min(left, key=lambda a: keys[a][f]) for f in set(points_to[a] for a in left)}
+        on_cycle = set()
+        for start in left:
+            path, agent = [], start
+            while agent not in path:
+                path.append(agent)
+                agent = top_agent[points_to[agent]]
+            on_cycle.update(path[path.index(agent):])
+        for agent in on_cycle:
+            assignments[agent] = points_to[agent]
+            remaining_capacity[points_to[agent]] -= 1
+        left -= on_cycle
+    return assignments
+
+
+def naive_probabilistic_serial(pref_list, capacities):
+    # Every agent eats its top available facility at unit speed.
+    remaining_capacity = capacities.astype(float)
+    probabilities = np.zeros((len(pref_list), len(capacities)))
+    time = 0
+    while time < 1 - 1e-12:
+        eating = {a: next((f for f in pref_list[a] if remaining_capacity[f] > 1e-9), -1) for a in range(len(pref_list))}
+        eating = {a: f for a, f in eating.items() if f >= 0}
+        if not eating:
+            break
+        eaters = np.bincount(list(eating.values()), minlength=len(capacities))
+        step = min(min(remaining_capacity[f] / eaters[f] for f in set(eating.values())), 1 - time)
+        for a, f in eating.items():
+            probabilities[a, f] += step
+            remaining_capacity[f] -= step
+        time += step
+    return probabilities
+
+
+@pytest.fixture(params=['compiled', 'block'])
+def rsd_path(request, monkeypatch):
+    """Runs random serial dictatorship with the numba kernel and with the vectorized block filling."""
+    if request.param == 'compiled' and allocation._serial_dictatorship is None:
+        pytest.skip('numba is not installed')
+    if request.param == 'block':
+        monkeypatch.setattr(allocation, '_serial_dictatorship', None)
+    return request.param
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('extend', [False, True])
+def test_random_serial_dictatorship_matches_naive(rsd_path, seed, extend):
+    full_pref_list, pref_list, capacities = random_instance(seed)
+    lottery = np.random.default_rng(seed).permutation(len(pref_list)).astype(np.int32)
+    remaining_capacity = capacities.copy()
+
+    assignments = random_serial_dictatorship(pref_list, remaining_capacity, extend_preferences=(lambda a: full_pref_list[a]) if extend else None, lottery=lottery)[:, 0]
+    # Extended lists start with the truncated list, so extending them on the fly is the same as using the full lists.
+    expected = naive_serial_dictatorship(full_pref_list if extend else pref_list, capacities, lottery)
+    np.testing.assert_array_equal(assignments, expected)
+    np.testing.assert_array_equal(remaining_capacity, capacities - np.bincount(expected[expected >= 0], minlength=len(capacities)))
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('total_capacity', [34, 24])
+@pytest.mark.parametrize('tie_breaking', ['single', 'multiple'])
+@pytest.mark.parametrize('with_priorities', [False, True])
+@pytest.mark.parametrize('mechanism, naive', [(deferred_acceptance, naive_deferred_acceptance), (top_trading_cycles, naive_top_trading_cycles)])
+def test_priority_mechanisms_match_naive(seed, total_capacity, tie_breaking, with_priorities, mechanism, naive):
+    full_pref_list, pref_list, capacities = random_instance(seed, total_capacity=total_capacity)
+    priorities = np.random.default_rng(seed + 100).integers(3, size=full_pref_list.shape) if with_priorities else None
+    keys = priority_keys(*full_pref_list.shape, priorities, tie_breaking, seed)
+
+    assignments = mechanism(pref_list, capacities.copy(), priorities=priorities, tie_breaking=tie_breaking, extend_preferences=lambda a: full_pref_list[a], rng=np.random.default_rng(seed))[:, 0]
+    np.testing.assert_array_equal(assignments, naive(full_pref_list.tolist(), capacities, keys))
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('extend', [False, True])
+def test_probabilistic_serial_matches_naive(seed, extend):
+    full_pref_list, pref_list, capacities = random_instance(seed, total_capacity=25)
+    # Classes of agents with identical lists eat at the speed of their size.
+    class_sizes = np.random.default_rng(seed).integers(1, 4, size=len(pref_list))
+    agent_class = np.repeat(np.arange(len(pref_list)), class_sizes)
+
+    probabilities = probabilistic_serial(pref_list, capacities, class_sizes, extend_preferences=(lambda c: full_pref_list[c]) if extend else None)
+    expected = naive_probabilistic_serial((full_pref_list if extend else pref_list)[agent_class], capacities)
+    np.testing.assert_allclose(probabilities[agent_class], expected, atol=1e-9)
+
+
+def test_random_serial_dictatorship_counts_matches_agent_lotteries():
+    full_pref_list, pref_list, capacities = random_instance(0, nr_agents=8, total_capacity=30)
+    class_sizes = np.array([6, 1, 3, 5, 2, 4, 3, 1])
+    agent_class = np.repeat(np.arange(len(pref_list)), class_sizes)
+    rng = np.random.default_rng(0)
+    nr_lotteries = 2000
+
+    counts = np.array([random_serial_dictatorship_counts(pref_list, capacities, class_sizes, extend_preferences=lambda c: full_pref_list[c], rng=rng) for _ in range(nr_lotteries)])
+    assert (counts.sum(axis=2) <= class_sizes).all()
+    assert (counts.sum(axis=1) <= capacities).all()
+
+    # Same distribution as the lotteries over the agents: compare the expected nr of agents of each class in each facility.
+    expected = np.zeros(counts.shape[1:])
+    for _ in range(nr_lotteries):
+        assignments = naive_serial_dictatorship(full_pref_list[agent_class], capacities, rng.permutation(len(agent_class)))
+        np.add.at(expected, (agent_class[assignments >= 0], assignments[assignments >= 0]), 1)
+    np.testing.assert_allclose(counts.mean(axis=0), expected / nr_lotteries, atol=0.2)
+
+
+@pytest.mark.parametrize('mechanism', ['rsd_compiled', 'rsd_block', 'deferred_acceptance', 'top_trading_cycles', 'top_trading_cycles_priorities'])
+def test_seat_shortage_leaves_agents_unassigned(mechanism, monkeypatch):
+    full_pref_list, pref_list, capacities = random_instance(0, nr_agents=20, total_capacity=14)
+    rng = np.random.default_rng(0)
+    extend_preferences = lambda a: full_pref_list[a]
+    if mechanism == 'rsd_compiled' and allocation._serial_dictatorship is None:
+        pytest.skip('numba is not installed')
+    if mechanism == 'rsd_block':
+        monkeypatch.setattr(allocation, '_serial_dictatorship', None)
+
+    if mechanism.startswith('rsd'):
+        assignments = random_serial_dictatorship(pref_list, capacities.copy(), extend_preferences=extend_preferences, rng=rng)
+    elif mechanism == 'deferred_acceptance':
+        assignments = deferred_acceptance(pref_list, capacities.copy(), extend_preferences=extend_preferences, rng=rng)
+    else:
+        priorities = rng.integers(3, size=full_pref_list.shape) if mechanism.endswith('priorities') else None
+        assignments = top_trading_cycles(pref_list, capacities.copy(), priorities=priorities, extend_preferences=extend_preferences, rng=rng)
+
+    # Every seat is taken and the 6 agents that don't fit are -1.
+    assert (assignments[:, 0] < 0).sum() == 6
+    np.testing.assert_array_equal(np.bincount(assignments[assignments >= 0], minlength=len(capacities)), capacities)
+
+    # The evaluation leaves the unassigned agents out of the means.
+    travel_time = rng.random(full_pref_list.shape)
+    eval_metrics = evaluate_allocations(assignments[np.newaxis], pref_list, travel_time, np.arange(20) % 2, capacities, 2)
+    assigned = assignments[:, 0] >= 0
+    np.testing.assert_allclose(eval_metrics['unassigned_share'], [0.3])
+    np.testing.assert_allclose(eval_metrics['mean_tt_to_alloc'], [travel_time[assigned, assignments[assigned, 0]].mean()])
@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+from intervention import get_candidate_edges, plan_facility_edges, rank_facility_edges
+
+FACILITIES = [2, 9, 9, 14]
+
+
+def facility_centrality(graph, facility_nodes, centrality_measure, group_weights):
+    """(Group) closeness of each facility (and group), straight from igraph's weighted distances - shape = (nr_facilities, nr_groups)."""
+    distances = np.array(graph.distances(source=facility_nodes, weights='weight'))
+    if centrality_measure == 'closeness':
+        return ((distances.shape[1] - 1) / distances.sum(axis=1))[:, np.newaxis]
+    return 1 / (distances @ group_weights.T)
+
+
+def with_edge(graph, u, v, weight=1):
+    graph = graph.copy()
+    graph.add_edge(u, v, weight=weight)
+    return graph
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('centrality_measure', ['closeness', 'group_closeness'])
+def test_rank_facility_edges_matches_brute_force(make_network, seed, centrality_measure):
+    network = make_network(seed=seed, calc_tt_mx=True)
+    group_weights = np.random.default_rng(seed).random((2, 20))
+    facility_nodes = np.unique(FACILITIES)
+    current = facility_centrality(network.network, facility_nodes.tolist(), centrality_measure, group_weights)
+
+    gains = {}
+    for fid, f in enumerate(facility_nodes.tolist()):
+        for _, c in get_candidate_edges(network, f):
+            centrality = facility_centrality(with_edge(network.network, f, c), [f], centrality_measure, group_weights)[0]
+            for gid, gain in enumerate(centrality - current[fid]):
+                gains[(f, c, None if centrality_measure == 'closeness' else gid)] = gain
+    expected = sorted(gains.values(), reverse=True)[:5]
+
+    top_edges = rank_facility_edges(network, FACILITIES, centrality_measure, group_weights=group_weights, top_k=5)
+    np.testing.assert_allclose([gain for gain, _, _, _ in top_edges], expected)
+    for gain, x, y, group_id in top_edges:
+        assert gains[(x, y, group_id)] == pytest.approx(gain)
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('centrality_measure', ['closeness', 'group_closeness'])
+def test_plan_facility_edges_matches_naive_greedy(make_network, seed, centrality_measure):
+    network = make_network(seed=seed, calc_tt_mx=True)
+    group_weights = np.random.default_rng(seed).random((2, 20))
+    facility_nodes = np.unique(FACILITIES).tolist()
+    budget = 3
+
+    # Naive greedy: add every candidate edge to a copy of the graph and recalculate the total centrality of the facilities.
+    def objective(graph):
+        return facility_centrality(graph, facility_nodes, centrality_measure, group_weights).sum()
+
+    candidates = [(u, v) for u in facility_nodes for _, v in get_candidate_edges(network, u) if not (v in facility_nodes and v < u)]
+    graph, expected = network.network.copy(), []
+    for _ in range(budget):
+        gains = [objective(with_edge(graph, u, v)) - objective(graph) if (u, v) not in expected else -np.inf for u, v in candidates]
+        if max(gains) <= 0:
+            break
+        expected.append(candidates[int(np.argmax(gains))])
+        graph = with_edge(graph, *expected[-1])
+
+    added_edges = plan_facility_edges(network, FACILITIES, centrality_measure, budget, group_weights=group_weights)
+    # Edges of undirected graphs are stored as (smaller id, larger id).
+    assert [(e.source, e.target) for e in added_edges] == [tuple(sorted(edge)) for edge in expected]
+    assert objective(network.network) == pytest.approx(objective(graph))
+    # The planner keeps the travel time matrix up to date.
+    np.testing.assert_allclose(network.tt_mx, network.calc_tt_mx())
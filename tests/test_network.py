@@ -0,0 +1,84 @@
+from collections import deque
+
+import numpy as np
+import pytest
+
+
+def naive_weighted_betweenness(network, weights):
+    """The original (dict based) Brandes loop of Network.weighted_betweeness, for a single weight vector."""
+    all_nodes = network.network.vs.indices
+    C = np.zeros(len(all_nodes))
+    A = network.network.neighborhood()
+    for s in all_nodes:
+        S = []
+        P = dict((w, []) for w in all_nodes)
+        g = dict((t, 0) for t in all_nodes); g[s] = 1
+        d = dict((t, -1) for t in all_nodes); d[s] = 0
+        Q = deque([s])
+        while Q:
+            v = Q.popleft()
+            S.append(v)
+            for w in A[v]:
+                if d[w] < 0:
+                    Q.append(w)
+                    d[w] = d[v] + 1
+                if d[w] == d[v] + 1:
+                    g[w] = g[w] + g[v]
+                    P[w].append(v)
+        e = dict((v, 0) for v in all_nodes)
+        while S:
+            w = S.pop()
+            for v in P[w]:
+                e[v] = e[v] + (g[v] / g[w]) * (1 + e[w]) * weights[w]
+            if w != s:
+                C[w] = C[w] + e[w]
+
+    return C / 2
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('compact', [False, True])
+def test_incremental_tt_mx_matches_recalculation(make_network, seed, compact):
+    rng = np.random.default_rng(seed)
+    targets = rng.choice(20, 5, replace=False) if compact else None
+    network = make_network(seed=seed, calc_tt_mx=True, tt_targets=targets)
+    for _ in range(4):
+        u, v = rng.choice(20, 2, replace=False).tolist()
+        network.add_edge(u, v, weight=float(rng.uniform(0.5, 3)))
+        np.testing.assert_allclose(network.tt_mx, network.calc_tt_mx())
+
+    # Compact matrices only hold the columns of the targets.
+    assert network.tt_mx.shape == (20, 5 if compact else 20)
+
+
+def test_tt_cache_is_memory_mapped_and_not_modified(make_network):
+    network = make_network(calc_tt_mx=True)
+    cached = make_network(calc_tt_mx=True, tt_cache=True)
+    assert not isinstance(cached.tt_mx, np.memmap)
+    np.testing.assert_array_equal(cached.tt_mx, network.tt_mx)
+
+    # Second load of the same graph comes from the cache.
+    cached = make_network(calc_tt_mx=True, tt_cache=True)
+    assert isinstance(cached.tt_mx, np.memmap)
+    np.testing.assert_array_equal(cached.tt_mx, network.tt_mx)
+
+    # In-place updates are copy-on-write, the cached file keeps the travel times of the original graph.
+    cached.add_edge(0, 10, weight=0.1)
+    np.testing.assert_allclose(cached.tt_mx, cached.calc_tt_mx())
+    np.testing.assert_array_equal(make_network(calc_tt_mx=True, tt_cache=True).tt_mx, network.tt_mx)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_vectorized_betweenness_matches_brandes_loop(make_network, seed):
+    network = make_network(nr_nodes=15, nr_extra_edges=10, seed=seed, weighted=False)
+    weights = np.random.default_rng(seed).random((2, 15))
+    nodes = [0, 3, 7, 7]
+
+    # Small batches, so the sources are split over several batches.
+    betweenness = network.weighted_betweeness(nodes, weights=weights, batch_size=4)
+    assert betweenness.shape == (2, len(nodes))
+    for group in range(2):
+        np.testing.assert_allclose(betweenness[group], naive_weighted_betweenness(network, weights[group])[nodes])
+
+    # Unit weights give the conventional (hop based) betweenness.
+    np.testing.assert_allclose(network.weighted_betweeness(nodes), np.array(network.network.betweenness(directed=False))[nodes])